@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# stress benchmark for the object cache: hits/sec from 1 to 64 threads for the
+# old single-lock OrderedDict against ShardedCache
+import argparse
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import proxy
+
+# the cache as it was before sharding: one lock around one OrderedDict
+class GlobalLockCache:
+    def __init__(self, max_bytes):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+
+def make_entry(size):
+    res = proxy.HTTPResponse('HTTP/1.1', 200, 'OK')
+    res.body = b'x' * size
+    return proxy.CacheEntry(res)
+
+def run(cache, keys, threads, duration, put_ratio):
+    counts = [0] * threads
+    go = threading.Event()
+    stop = threading.Event()
+    entry = make_entry(64)
+
+    def worker(i):
+        rng = random.Random(i)
+        n = 0
+        go.wait()
+        while not stop.is_set():
+            for _ in range(256):
+                key = rng.choice(keys)
+                if put_ratio and rng.random() < put_ratio:
+                    cache.put(key, entry)
+                else:
+                    cache.get(key)
+                n += 1
+        counts[i] = n
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    # start every thread before any of them runs, so start-up is not measured
+    for t in workers:
+        t.start()
+    go.set()
+    time.sleep(duration)
+    stop.set()
+    for t in workers:
+        t.join()
+    return sum(counts) / duration
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=10000, help="distinct cached URLs")
+    parser.add_argument('--duration', type=float, default=2.0, help="seconds per run")
+    parser.add_argument('--put-ratio', type=float, default=0.0, help="fraction of operations that insert")
+    parser.add_argument('--shards', type=int, default=proxy.CACHE_SHARDS)
+    args = parser.parse_args()
+
+    keys = [f"http://example.com:80/object/{i}" for i in range(args.keys)]
+    caches = {
+        "global lock": GlobalLockCache(1 << 40),
+        f"sharded x{args.shards}": proxy.ShardedCache(1 << 40, args.shards),
+    }
+    for cache in caches.values():
+        for key in keys:
+            cache.put(key, make_entry(64))
+
+    print(f"{'threads':>8s}" + ''.join(f"{name:>18s}" for name in caches))
+    for threads in (1, 2, 4, 8, 16, 32, 64):
+        rates = [run(cache, keys, threads, args.duration, args.put_ratio) for cache in caches.values()]
+        print(f"{threads:8d}" + ''.join(f"{rate:14.0f} op/s" for rate in rates))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# micro-benchmark comparing the old byte-at-a-time chunked recv loop with
+# BodyDecoder over a SocketReader, on a chunked body served over loopback
+import argparse
+import socket
+import threading
+import time
+
+import proxy
+
+# serve the same chunked body to every connection
+def serve(listener, body_size, chunk_size):
+    chunk = b'%x\r\n' % chunk_size + b'x' * chunk_size + b'\r\n'
+    full, tail = divmod(body_size, chunk_size)
+    last = (b'%x\r\n' % tail + b'x' * tail + b'\r\n') if tail else b''
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        with conn:
+            try:
+                for _ in range(full):
+                    conn.sendall(chunk)
+                conn.sendall(last + b'0\r\n\r\n')
+            except OSError:
+                pass
+
+# the decoding loop handle_client used before BodyDecoder
+def decode_old(sock):
+    def recv_exact(length):
+        buf = bytearray()
+        while len(buf) < length:
+            chunk = sock.recv(length - len(buf))
+            if not chunk:
+                break
+            buf.extend(chunk)
+        return bytes(buf)
+
+    buf = bytearray()
+    while True:
+        line = b''
+        while not line.endswith(b'\r\n'):
+            byte = sock.recv(1)
+            if not byte:
+                break
+            line += byte
+        if not line:
+            break
+        size = int(line.strip().split(b';',1)[0], 16)
+        if size == 0:
+            sock.recv(2)
+            break
+        data = recv_exact(size + 2)
+        buf.extend(data[:-2])
+    return len(buf)
+
+def decode_new(sock):
+    total = 0
+    for piece in proxy.iter_body(proxy.SocketReader(sock), proxy.BodyDecoder('chunked')):
+        total += len(piece)
+    return total
+
+def run(addr, decode, rounds):
+    best = None
+    for _ in range(rounds):
+        with socket.create_connection(addr) as sock:
+            start = time.perf_counter()
+            n = decode(sock)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return n, best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100 * 1024 * 1024, help="body size in bytes")
+    parser.add_argument('--chunk', type=int, default=8192, help="chunk size in bytes")
+    parser.add_argument('--rounds', type=int, default=3, help="runs per decoder, best is reported")
+    args = parser.parse_args()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    threading.Thread(target=serve, args=(listener, args.size, args.chunk), daemon=True).start()
+    addr = listener.getsockname()
+
+    print(f"Body: {args.size} bytes in {args.chunk} byte chunks, best of {args.rounds}")
+    for name, decode in (("old recv(1) loop", decode_old), ("BodyDecoder", decode_new)):
+        n, elapsed = run(addr, decode, args.rounds)
+        assert n == args.size, f"{name} decoded {n} bytes"
+        print(f"{name:18s} {elapsed:7.3f}s  {n / elapsed / 1e6:9.1f} MB/s")
+    listener.close()
+
+if __name__ == '__main__':
+    main()
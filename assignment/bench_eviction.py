@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# replays access logs in the proxy's log.log format against each eviction
+# policy of the memory cache and reports object and byte hit ratios, to choose
+# --eviction for a given max cache size. Only logged GETs answered 200 are
+# replayed, keyed by normalised URL and sized by the logged body bytes; the
+# cache flags in the log are ignored, every policy starts empty
+import argparse
+import random
+import re
+import sys
+import time
+
+import proxy
+
+# ip port flag [date] "METHOD url version" status bytes
+CLF_LINE = re.compile(r'^\S+ \S+ \S \[[^\]]*\] "(\S+) (\S+) [^"]*" (\d{3}) (\d+)$')
+
+# stands in for a CacheEntry, the policies only look at the size
+class TraceObject:
+    def __init__(self, size: int):
+        self.size = size
+
+def read_trace(paths) -> list:
+    trace = []
+    skipped = 0
+    for path in paths:
+        with open(path, encoding='latin-1') as log_file:
+            for line in log_file:
+                m = CLF_LINE.match(line.strip())
+                if m is None or m.group(1) != 'GET' or m.group(3) != '200':
+                    skipped += 1
+                    continue
+                trace.append((proxy.normalise_url(m.group(2)), int(m.group(4))))
+    print(f"{len(trace)} GET 200 requests replayed, {skipped} other lines skipped", file=sys.stderr)
+    return trace
+
+# Zipf-popular objects of mixed sizes, interrupted by scans of one-off objects:
+# the pattern where LRU loses its hot set
+def synthetic_trace(requests: int, objects: int, zipf: float, scan_every: int, scan_length: int,
+                    max_object_size: int, seed: int) -> list:
+    rng = random.Random(seed)
+    sizes = [min(max_object_size, int(rng.lognormvariate(9, 1.5)) + 1) for _ in range(objects)]
+    weights = [1 / (i + 1) ** zipf for i in range(objects)]
+    popular = rng.choices(range(objects), weights, k=requests)
+    trace = []
+    scanned = 0
+    for n, i in enumerate(popular):
+        trace.append((f"http://origin:80/object/{i}", sizes[i]))
+        if scan_every and n % scan_every == scan_every - 1:
+            for _ in range(scan_length):
+                trace.append((f"http://origin:80/scan/{scanned}", rng.randint(max_object_size // 4, max_object_size)))
+                scanned += 1
+    return trace
+
+def replay(trace: list, policy: str, max_bytes: int, max_object_size: int, shards: int) -> dict:
+    cache = proxy.ShardedCache(max_bytes, shards, policy)
+    hits = hit_bytes = total_bytes = 0
+    start = time.perf_counter()
+    for key, size in trace:
+        total_bytes += size
+        if cache.get(key) is not None:
+            hits += 1
+            hit_bytes += size
+        elif size <= max_object_size:
+            cache.put(key, TraceObject(size))
+    elapsed = time.perf_counter() - start
+    return {
+        'object_hit_ratio': hits / len(trace) if trace else 0.0,
+        'byte_hit_ratio': hit_bytes / total_bytes if total_bytes else 0.0,
+        'evictions': cache.evictions,
+        'replay_us': elapsed / len(trace) * 1e6 if trace else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logs', nargs='*', default=[proxy.LOG_FILE], help="access logs to replay, in order")
+    parser.add_argument('--max-cache-size', type=int, action='append',
+                        help="cache byte budget, repeat to compare several (default the proxy's)")
+    parser.add_argument('--max-object-size', type=int, default=proxy.MAX_OBJECT_SIZE)
+    parser.add_argument('--shards', type=int, default=proxy.CACHE_SHARDS)
+    parser.add_argument('--policy', action='append', choices=sorted(proxy.EVICTION_POLICIES),
+                        help="policy to replay, repeat for several (default all)")
+    synthetic = parser.add_argument_group('synthetic trace, used instead of the logs')
+    synthetic.add_argument('--synthetic', type=int, metavar='N', help="generate N popular requests")
+    synthetic.add_argument('--objects', type=int, default=20000, help="distinct popular URLs")
+    synthetic.add_argument('--zipf', type=float, default=0.9, help="skew of popularity")
+    synthetic.add_argument('--scan-every', type=int, default=5000, help="popular requests between scans, 0 for none")
+    synthetic.add_argument('--scan-length', type=int, default=200, help="one-off large objects per scan")
+    synthetic.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        trace = synthetic_trace(args.synthetic, args.objects, args.zipf, args.scan_every, args.scan_length,
+                                args.max_object_size, args.seed)
+    else:
+        trace = read_trace(args.logs)
+    policies = args.policy or sorted(proxy.EVICTION_POLICIES)
+
+    print(f"{'cache bytes':>12s} {'policy':>8s} {'object hit':>11s} {'byte hit':>9s} {'evictions':>10s} {'us/req':>7s}")
+    for max_bytes in args.max_cache_size or [proxy.MAX_CACHE_SIZE]:
+        for policy in policies:
+            r = replay(trace, policy, max_bytes, args.max_object_size, args.shards)
+            print(f"{max_bytes:12d} {policy:>8s} {r['object_hit_ratio']:11.3f} {r['byte_hit_ratio']:9.3f} "
+                  f"{r['evictions']:10d} {r['replay_us']:7.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# offline load benchmark: starts a local origin and the proxy, drives the proxy at a
+# fixed concurrency (closed loop) or a fixed request rate (open loop) from client
+# processes, and reports throughput, latency percentiles, hit ratio and proxy RSS,
+# optionally as JSON so runs of different builds can be compared
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import selectors
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import proxy
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# ---------------------------------------------------------------------------
+# stand-in origin
+# ---------------------------------------------------------------------------
+
+# one keep-alive origin connection: every GET gets the same body after the
+# configured delay, sent with a content-length or chunked
+def origin_conn(conn, args, head, body, served):
+    reader = proxy.SocketReader(conn)
+    try:
+        while True:
+            start = reader.read_head()
+            if start < 0:
+                return
+            reader.consume(reader.buf.find(b"\r\n\r\n", start) + 4)
+            if args.origin_latency:
+                time.sleep(args.origin_latency / 1000)
+            with served.get_lock():
+                served.value += 1
+            if args.chunked:
+                proxy.send_parts(conn, [head] + [b'%x\r\n%s\r\n' % (len(body[i:i+16384]), body[i:i+16384])
+                                                 for i in range(0, len(body), 16384)] + [b'0\r\n\r\n'])
+            else:
+                proxy.send_parts(conn, [head, body])
+    except (OSError, ValueError):
+        pass
+    finally:
+        conn.close()
+
+def origin_main(listener, args, served):
+    body = b'x' * args.size
+    head = b"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+    head += b"Cache-Control: no-store\r\n" if args.no_store else b"Cache-Control: max-age=3600\r\n"
+    head += b"Transfer-Encoding: chunked\r\n\r\n" if args.chunked else b"Content-Length: %d\r\n\r\n" % args.size
+    while True:
+        conn, _ = listener.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=origin_conn, args=(conn, args, head, body, served), daemon=True).start()
+
+# ---------------------------------------------------------------------------
+# load generator
+# ---------------------------------------------------------------------------
+
+# one keep-alive connection to the proxy with at most one request outstanding
+class Client:
+    def __init__(self, addr):
+        self.sock = socket.create_connection(addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self.buf = bytearray()
+        self.res = None
+        self.decoder = None
+        self.sent_at = None     # when the outstanding request was due, None if idle
+
+    def send(self, request: bytes, due: float):
+        self.sent_at = due
+        self.sock.sendall(request)
+
+    # feed received bytes, returns (status, body bytes) once the response is complete
+    def feed(self, data: bytes):
+        self.buf += data
+        if self.res is None:
+            try:
+                self.res, body_start = proxy.parse_response_head(self.buf)
+            except ValueError:
+                if len(self.buf) > proxy.MAX_HEAD:
+                    raise
+                return None
+            framing = 'chunked' if 'chunked' in self.res.headers.get('transfer-encoding', '') else 'length'
+            self.decoder = proxy.make_decoder(framing, self.res.headers)
+            data, self.buf = bytes(self.buf[body_start:]), bytearray()
+            self.length = 0
+        for piece in self.decoder.feed(data):
+            self.length += len(piece)
+        if not self.decoder.done:
+            return None
+        self.buf = bytearray(self.decoder.unused)
+        res, self.res = self.res, None
+        return res.status_code, self.length
+
+# URLs for one client process, drawn from a Zipf distribution over the objects
+# (uniform when zipf is 0) so a few objects are hot and the rest trail off
+def request_stream(args, origin_port, seed):
+    weights = [1 / (rank ** args.zipf) for rank in range(1, args.objects + 1)]
+    rng = random.Random(seed)
+    ranks = rng.choices(range(args.objects), weights=weights, k=65536)
+    requests = [(f"GET http://127.0.0.1:{origin_port}/object/{rank} HTTP/1.1\r\n"
+                 f"Host: 127.0.0.1:{origin_port}\r\n\r\n").encode('ascii') for rank in range(args.objects)]
+    while True:
+        for rank in ranks:
+            yield requests[rank]
+
+def client_main(index, args, proxy_addr, origin_port, start_at, results):
+    connections = args.concurrency // args.processes + (index < args.concurrency % args.processes)
+    rate = args.rate / args.processes if args.rate else 0
+    measure_from = start_at + args.warmup
+    stop_at = measure_from + args.duration
+    stream = request_stream(args, origin_port, args.seed + index)
+    sel = selectors.DefaultSelector()
+    idle = deque()
+    for _ in range(connections):
+        client = Client(proxy_addr)
+        sel.register(client.sock, selectors.EVENT_READ, client)
+        idle.append(client)
+
+    latencies, statuses, errors, body_bytes = [], {}, 0, 0
+    # open loop: requests fall due at a fixed rate whether or not earlier ones have
+    # finished, and latency counts from when each was due, queueing included
+    due = deque()
+    next_due = start_at
+    while time.monotonic() < start_at:
+        time.sleep(0.001)
+
+    while True:
+        now = time.monotonic()
+        if now >= stop_at:
+            break
+        if rate:
+            while next_due <= now:
+                due.append(next_due)
+                next_due += 1 / rate
+            while due and idle:
+                idle.popleft().send(next(stream), due.popleft())
+        else:
+            while idle:
+                idle.popleft().send(next(stream), now)
+        timeout = min(stop_at, next_due) - now if rate else stop_at - now
+        for key, _ in sel.select(max(timeout, 0)):
+            client = key.data
+            try:
+                data = client.sock.recv(262144)
+                if not data:
+                    raise ConnectionError("proxy closed the connection")
+                done = client.feed(data)
+            except (OSError, ValueError):
+                errors += 1
+                sel.unregister(client.sock)
+                client.sock.close()
+                client = Client(proxy_addr)
+                sel.register(client.sock, selectors.EVENT_READ, client)
+                idle.append(client)
+                continue
+            if done is None:
+                continue
+            finished = time.monotonic()
+            if finished >= measure_from:
+                status, length = done
+                latencies.append(finished - client.sent_at)
+                statuses[status] = statuses.get(status, 0) + 1
+                body_bytes += length
+            client.sent_at = None
+            if rate and due:
+                client.send(next(stream), due.popleft())
+            elif rate:
+                idle.append(client)
+            else:
+                client.send(next(stream), finished)
+    results.put({'latencies': latencies, 'statuses': statuses, 'errors': errors,
+                 'body_bytes': body_bytes, 'backlog': len(due)})
+
+# ---------------------------------------------------------------------------
+# proxy process
+# ---------------------------------------------------------------------------
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_listening(addr, proc=None, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(addr, timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline or (proc is not None and proc.poll() is not None):
+                raise
+            time.sleep(0.05)
+
+# resident set size of a process and all of its children, in bytes
+def tree_rss(pid: int) -> int:
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                for child in f.read().split():
+                    total += tree_rss(int(child))
+    except OSError:
+        pass
+    return total
+
+class RSSSampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.25):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.last = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.last = tree_rss(self.pid)
+            self.peak = max(self.peak, self.last)
+            self.stopped.wait(self.interval)
+
+def percentile(ordered: list, fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    load = parser.add_argument_group('load')
+    load.add_argument('--concurrency', type=int, default=32, help="keep-alive connections to the proxy")
+    load.add_argument('--rate', type=float, default=0,
+                      help="open loop: requests/sec across all connections (default: closed loop)")
+    load.add_argument('--duration', type=float, default=10.0, help="measured seconds")
+    load.add_argument('--warmup', type=float, default=2.0, help="seconds of load before measuring")
+    load.add_argument('--processes', type=int, default=min(4, os.cpu_count() or 1),
+                      help="client processes the connections are spread over")
+    load.add_argument('--objects', type=int, default=100, help="distinct URLs")
+    load.add_argument('--zipf', type=float, default=1.0, help="skew of URL popularity, 0 for uniform")
+    load.add_argument('--seed', type=int, default=1)
+    origin = parser.add_argument_group('origin')
+    origin.add_argument('--size', type=int, default=4096, help="response body bytes")
+    origin.add_argument('--origin-latency', type=float, default=0, help="ms the origin waits before answering")
+    origin.add_argument('--chunked', action='store_true', help="send bodies chunked instead of with a length")
+    origin.add_argument('--no-store', action='store_true', help="mark responses uncacheable")
+    target = parser.add_argument_group('proxy')
+    target.add_argument('--proxy', metavar='HOST:PORT', help="use a running proxy instead of starting one")
+    target.add_argument('--proxy-pid', type=int, help="pid of a running proxy, to sample its RSS")
+    target.add_argument('--max-object-size', type=int, default=1 << 20)
+    target.add_argument('--max-cache-size', type=int, default=64 << 20)
+    target.add_argument('--proxy-args', default='',
+                        help="extra proxy.py options, e.g. '--engine async --workers 4'")
+    parser.add_argument('--label', help="name for this run in the JSON output")
+    parser.add_argument('--json', metavar='FILE', help="write the results as JSON, - for stdout")
+    args = parser.parse_args()
+    if args.concurrency < args.processes:
+        args.processes = args.concurrency
+
+    # origin in its own process so it does not share a GIL with the clients
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    origin_port = listener.getsockname()[1]
+    served = mp.Value('q', 0)
+    origin_proc = mp.Process(target=origin_main, args=(listener, args, served), daemon=True)
+    origin_proc.start()
+    listener.close()
+
+    proxy_proc = None
+    logdir = tempfile.TemporaryDirectory()
+    if args.proxy:
+        host, port = args.proxy.rsplit(':', 1)
+        proxy_addr = (host, int(port))
+        proxy_pid = args.proxy_pid
+    else:
+        proxy_addr = ('127.0.0.1', free_port())
+        cmd = [sys.executable, os.path.join(HERE, 'proxy.py'), str(proxy_addr[1]), '30',
+               str(args.max_object_size), str(args.max_cache_size)] + shlex.split(args.proxy_args)
+        # its access log and output go to a scratch directory, not the log.log next to it
+        proxy_out = open(os.path.join(logdir.name, 'proxy.out'), 'w+')
+        proxy_proc = subprocess.Popen(cmd, cwd=logdir.name, stdout=subprocess.DEVNULL, stderr=proxy_out)
+        proxy_pid = proxy_proc.pid
+    sampler = None
+    try:
+        try:
+            wait_listening(proxy_addr, proxy_proc)
+        except OSError:
+            if proxy_proc is not None:
+                proxy_out.seek(0)
+                sys.stderr.write(proxy_out.read())
+            raise
+        if proxy_pid:
+            sampler = RSSSampler(proxy_pid)
+            sampler.start()
+
+        results = mp.Queue()
+        start_at = time.monotonic() + 0.5
+        clients = [mp.Process(target=client_main, args=(i, args, proxy_addr, origin_port, start_at, results))
+                   for i in range(args.processes)]
+        for p in clients:
+            p.start()
+        # origin requests during the measured window only
+        time.sleep(max(0, start_at + args.warmup - time.monotonic()))
+        served_before = served.value
+        time.sleep(max(0, start_at + args.warmup + args.duration - time.monotonic()))
+        served_during = served.value - served_before
+        parts = [results.get() for _ in clients]
+        for p in clients:
+            p.join()
+    finally:
+        if sampler is not None:
+            sampler.stopped.set()
+            sampler.join()
+        if proxy_proc is not None:
+            proxy_proc.terminate()
+            try:
+                proxy_proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proxy_proc.kill()
+            proxy_out.close()
+        origin_proc.terminate()
+        logdir.cleanup()
+
+    latencies = sorted(lat for part in parts for lat in part['latencies'])
+    statuses = {}
+    for part in parts:
+        for status, n in part['statuses'].items():
+            statuses[str(status)] = statuses.get(str(status), 0) + n
+    completed = len(latencies)
+    report = {
+        'label': args.label,
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('json', 'label')},
+        'requests': completed,
+        'throughput_rps': completed / args.duration,
+        'throughput_mbps': sum(part['body_bytes'] for part in parts) / args.duration / 1e6,
+        'latency_ms': {name: percentile(latencies, q) * 1000
+                       for name, q in (('p50', .5), ('p90', .9), ('p99', .99), ('p999', .999))},
+        'latency_max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        'statuses': statuses,
+        'errors': sum(part['errors'] for part in parts),
+        # open loop only: requests that fell due but never got a free connection
+        'backlog': sum(part['backlog'] for part in parts),
+        'origin_requests': served_during,
+        # share of requests the origin never saw: cache hits and coalesced misses
+        'hit_ratio': max(0.0, 1 - served_during / completed) if completed else 0.0,
+        'rss_peak_bytes': sampler.peak if sampler else None,
+        'rss_end_bytes': sampler.last if sampler else None,
+    }
+
+    mode = f"{args.rate:.0f} req/s open loop" if args.rate else "closed loop"
+    print(f"{args.concurrency} connections, {mode}, {args.objects} objects of {args.size} bytes, "
+          f"{args.duration:.0f}s after {args.warmup:.0f}s warmup", file=sys.stderr)
+    print(f"throughput   {report['throughput_rps']:10.0f} req/s {report['throughput_mbps']:8.1f} MB/s", file=sys.stderr)
+    print("latency ms   " + "  ".join(f"{k} {v:.2f}" for k, v in report['latency_ms'].items())
+          + f"  max {report['latency_max_ms']:.2f}", file=sys.stderr)
+    print(f"hit ratio    {report['hit_ratio']:10.3f}   ({served_during} origin requests)", file=sys.stderr)
+    print(f"statuses     {statuses}  errors {report['errors']}  backlog {report['backlog']}", file=sys.stderr)
+    if sampler:
+        print(f"proxy RSS    peak {sampler.peak / 2**20:.1f} MiB, end {sampler.last / 2**20:.1f} MiB", file=sys.stderr)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,286 @@
 import sys
 import socket
 import select
+import selectors
 from typing import Dict, Tuple
 import traceback
 import json
 import threading
 import time
-from collections import OrderedDict
+import argparse
+import asyncio
+import email.utils
+import os
+import mmap
+import hashlib
+import struct
+import queue
+import tempfile
+import signal
+import shutil
+import re
+import errno
+import heapq
+import gzip
+import zlib
+import concurrent.futures
+from collections import Counter, OrderedDict
 
-# parse cli arguments
-if len(sys.argv) != 5:
-    print("Usage: python proxy.py <port> <timeout> <max_object_size> <max_cache_size>")
-    sys.exit(1)
+# defaults, overwritten from the command line by parse_args()
+PORT = 8080
+TIMEOUT = 10
+MAX_OBJECT_SIZE = 1024 * 1024
+MAX_CACHE_SIZE = 10 * 1024 * 1024
+ENGINE = 'thread'
+WORKERS = 1                 # processes accepting on PORT, more than one shares the cache through a cache process
+CACHE_SHARDS = 16           # independently locked cache segments
+EVICTION = 'lru'            # eviction policy of the memory cache, a key of EVICTION_POLICIES
+DEFAULT_TTL = 300           # freshness of responses with no expiry information or Last-Modified
+COMPRESS_LEVEL = 1          # gzip level for storing compressible bodies, 0 stores every body as received
 
-PORT = int(sys.argv[1])
-TIMEOUT = int(sys.argv[2])
-MAX_OBJECT_SIZE = int(sys.argv[3])
-MAX_CACHE_SIZE = int(sys.argv[4])
+# upstream connection pool limits
+POOL_MAX_IDLE = 64          # idle origin connections kept in total
+POOL_MAX_PER_HOST = 8       # idle connections kept per (host, port)
+POOL_IDLE_TIMEOUT = 15      # seconds before an idle connection is dropped
 
-VERBOSE = True
+# origin name resolution
+DNS_TTL = 60                # seconds a resolved origin address is reused, 0 disables the cache
+DNS_NEGATIVE_TTL = 5        # seconds a failed lookup is answered from the cache
+DNS_CACHE_SIZE = 1024       # names kept, least recently used dropped first
+HAPPY_EYEBALLS_DELAY = 0.25 # seconds before racing an origin's next address, 0 tries them in turn
+
+# admission control
+MAX_WORKERS = 128           # threads serving clients in the threaded engine
+ACCEPT_QUEUE = 256          # accepted connections waiting for a free worker
+MAX_PER_IP = 0              # concurrent connections per client address, 0 for no limit; opt-in, as
+                            # every client of the loopback listener shares one address
+
+# optional on-disk second tier, disabled unless --disk-cache is given
+DISK_CACHE_DIR = None
+DISK_CACHE_SIZE = 1024 * 1024 * 1024
+DISK_MAX_OBJECT_SIZE = 256 * 1024 * 1024
 
-lock = threading.Lock()
+# cache warm-up, disabled unless --snapshot or --prefetch is given
+SNAPSHOT_FILE = None        # memory cache saved here on shutdown and loaded on start
+SNAPSHOT_INTERVAL = 300     # seconds between snapshots while running, 0 saves only on shutdown
+PREFETCH_LOG = None         # access log whose most requested URLs are fetched before serving
+PREFETCH_COUNT = 1000       # URLs prefetched
+PREFETCH_PARALLEL = 8       # origin fetches in flight during the prefetch
 
-# error handling for args
-if not (1 <= PORT <= 65535):
-    print("Port must be between 1 and 65535")
-    sys.exit(1)
-if TIMEOUT < 1:
-    print("Timeout must be a positive integer")
-    sys.exit(1)
-if MAX_OBJECT_SIZE < 1 or MAX_CACHE_SIZE < MAX_OBJECT_SIZE:
-    print("Max object size must be >0 and <= max cache size")
-    sys.exit(1)
+# access log
+LOG_FILE = 'log.log'
+LOG_QUEUE = 10000           # entries waiting for the log writer
+LOG_FLUSH_INTERVAL = 1.0    # seconds between flushes of the log file
+LOG_OVERFLOW = 'block'      # full queue: block the request, drop the entry, or count (drop and report)
+
+VERBOSE = True
 
 HOST = '127.0.0.1'
 
+# parse cli arguments
+def parse_args(argv):
+    global PORT, TIMEOUT, MAX_OBJECT_SIZE, MAX_CACHE_SIZE, ENGINE, WORKERS
+    global POOL_MAX_IDLE, POOL_MAX_PER_HOST, POOL_IDLE_TIMEOUT
+    global DNS_TTL, DNS_NEGATIVE_TTL, HAPPY_EYEBALLS_DELAY
+    global CACHE_SHARDS, EVICTION, DEFAULT_TTL, COMPRESS_LEVEL, cache
+    global DISK_CACHE_DIR, DISK_CACHE_SIZE, DISK_MAX_OBJECT_SIZE, disk_cache
+    global SNAPSHOT_FILE, SNAPSHOT_INTERVAL, PREFETCH_LOG, PREFETCH_COUNT, PREFETCH_PARALLEL
+    global LOG_QUEUE, LOG_FLUSH_INTERVAL, LOG_OVERFLOW, access_log
+    global MAX_WORKERS, ACCEPT_QUEUE, MAX_PER_IP, admission
+    usage = "python proxy.py <port> <timeout> <max_object_size> <max_cache_size> [--engine=thread|async]"
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument('port', type=int)
+    parser.add_argument('timeout', type=int)
+    parser.add_argument('max_object_size', type=int)
+    parser.add_argument('max_cache_size', type=int)
+    parser.add_argument('--engine', choices=('thread', 'async'), default='thread',
+                        help="thread: one thread per client (default), async: single event loop")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="processes accepting on the port with SO_REUSEPORT, sharing one cache")
+    parser.add_argument('--cache-shards', type=int, default=CACHE_SHARDS,
+                        help="number of independently locked cache segments")
+    parser.add_argument('--eviction', choices=sorted(EVICTION_POLICIES), default=EVICTION,
+                        help="memory cache eviction: lru (default), gdsf (size-aware) or tinylfu (frequency admission)")
+    parser.add_argument('--default-ttl', type=int, default=DEFAULT_TTL,
+                        help="seconds a response without Cache-Control, Expires or Last-Modified stays fresh")
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=COMPRESS_LEVEL, metavar='0-9',
+                        help="gzip level for cached text bodies, 0 to store them uncompressed")
+    parser.add_argument('--pool-max-idle', type=int, default=POOL_MAX_IDLE,
+                        help="idle origin connections kept in total (0 disables reuse)")
+    parser.add_argument('--pool-max-per-host', type=int, default=POOL_MAX_PER_HOST,
+                        help="idle origin connections kept per host:port")
+    parser.add_argument('--pool-idle-timeout', type=float, default=POOL_IDLE_TIMEOUT,
+                        help="seconds an idle origin connection may be reused")
+    parser.add_argument('--dns-ttl', type=float, default=DNS_TTL,
+                        help="seconds a resolved origin address is reused (0 resolves every connection)")
+    parser.add_argument('--dns-negative-ttl', type=float, default=DNS_NEGATIVE_TTL,
+                        help="seconds a name that failed to resolve keeps failing without a new lookup")
+    parser.add_argument('--happy-eyeballs-delay', type=float, default=HAPPY_EYEBALLS_DELAY,
+                        help="seconds before also trying an origin's next address (0 tries them one after another)")
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS,
+                        help="threads serving clients (thread engine)")
+    parser.add_argument('--accept-queue', type=int, default=ACCEPT_QUEUE,
+                        help="connections waiting for a worker before new ones get 503, at least 1 (thread engine)")
+    parser.add_argument('--max-per-ip', type=int, default=MAX_PER_IP,
+                        help="concurrent connections per client address before 503 (default 0, no limit)")
+    parser.add_argument('--disk-cache', metavar='DIR', default=DISK_CACHE_DIR,
+                        help="keep objects evicted from memory, or too large for it, in DIR")
+    parser.add_argument('--disk-cache-size', type=int, default=DISK_CACHE_SIZE,
+                        help="byte budget of the disk cache")
+    parser.add_argument('--disk-max-object-size', type=int, default=DISK_MAX_OBJECT_SIZE,
+                        help="largest object kept on disk")
+    parser.add_argument('--snapshot', metavar='FILE', default=SNAPSHOT_FILE,
+                        help="save the memory cache to FILE on shutdown and periodically, and load it on start")
+    parser.add_argument('--snapshot-interval', type=float, default=SNAPSHOT_INTERVAL,
+                        help="seconds between snapshots while running (0 saves only on shutdown)")
+    parser.add_argument('--prefetch', metavar='LOG', default=PREFETCH_LOG,
+                        help="before serving, fetch the most requested GET URLs of an access log in this format")
+    parser.add_argument('--prefetch-count', type=int, default=PREFETCH_COUNT,
+                        help="number of URLs to prefetch")
+    parser.add_argument('--prefetch-parallel', type=int, default=PREFETCH_PARALLEL,
+                        help="origin fetches in flight while prefetching")
+    parser.add_argument('--log-queue', type=int, default=LOG_QUEUE,
+                        help="log entries waiting to be written before the overflow policy applies")
+    parser.add_argument('--log-flush-interval', type=float, default=LOG_FLUSH_INTERVAL,
+                        help="seconds between flushes of the log file")
+    parser.add_argument('--log-overflow', choices=('block', 'drop', 'count'), default=LOG_OVERFLOW,
+                        help="when the log queue is full: wait, drop the entry, or drop it and report the count")
+    args = parser.parse_args(argv)
+
+    # error handling for args
+    if not (1 <= args.port <= 65535):
+        print("Port must be between 1 and 65535")
+        sys.exit(1)
+    if args.timeout < 1:
+        print("Timeout must be a positive integer")
+        sys.exit(1)
+    if args.max_object_size < 1 or args.max_cache_size < args.max_object_size:
+        print("Max object size must be >0 and <= max cache size")
+        sys.exit(1)
+    if args.cache_shards < 1:
+        print("Cache shards must be a positive integer")
+        sys.exit(1)
+    if args.workers < 1 or (args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT')):
+        print("Workers must be a positive integer, and more than one needs SO_REUSEPORT")
+        sys.exit(1)
+    if args.max_workers < 1 or args.accept_queue < 1 or args.max_per_ip < 0:
+        print("Max workers and accept queue must be positive, per-ip limit not negative")
+        sys.exit(1)
+    if args.disk_cache and args.disk_cache_size < args.disk_max_object_size:
+        print("Disk max object size must be <= disk cache size")
+        sys.exit(1)
+    if args.snapshot_interval < 0 or args.prefetch_count < 0 or args.prefetch_parallel < 1:
+        print("Snapshot interval and prefetch count must not be negative, prefetch parallelism positive")
+        sys.exit(1)
+
+    PORT = args.port
+    TIMEOUT = args.timeout
+    MAX_OBJECT_SIZE = args.max_object_size
+    MAX_CACHE_SIZE = args.max_cache_size
+    ENGINE = args.engine
+    WORKERS = args.workers
+    CACHE_SHARDS = args.cache_shards
+    EVICTION = args.eviction
+    DEFAULT_TTL = args.default_ttl
+    COMPRESS_LEVEL = args.compress_level
+    cache = ShardedCache(MAX_CACHE_SIZE, CACHE_SHARDS, EVICTION)
+    DISK_CACHE_DIR = args.disk_cache
+    DISK_CACHE_SIZE = args.disk_cache_size
+    DISK_MAX_OBJECT_SIZE = args.disk_max_object_size
+    disk_cache = None
+    # with several workers the disk tier is opened by the cache process, and workers
+    # spill large bodies into its directory for it to adopt
+    if DISK_CACHE_DIR and WORKERS == 1:
+        open_disk_cache()
+    SNAPSHOT_FILE = args.snapshot
+    SNAPSHOT_INTERVAL = args.snapshot_interval
+    PREFETCH_LOG = args.prefetch
+    PREFETCH_COUNT = args.prefetch_count
+    PREFETCH_PARALLEL = args.prefetch_parallel
+    LOG_QUEUE = args.log_queue
+    LOG_FLUSH_INTERVAL = args.log_flush_interval
+    LOG_OVERFLOW = args.log_overflow
+    access_log = AccessLog(LOG_FILE, LOG_QUEUE, LOG_FLUSH_INTERVAL, LOG_OVERFLOW)
+    MAX_WORKERS = args.max_workers
+    ACCEPT_QUEUE = args.accept_queue
+    MAX_PER_IP = args.max_per_ip
+    admission = Admission(MAX_PER_IP)
+    POOL_MAX_IDLE = args.pool_max_idle
+    POOL_MAX_PER_HOST = args.pool_max_per_host
+    POOL_IDLE_TIMEOUT = args.pool_idle_timeout
+    upstream_pool.configure(POOL_MAX_IDLE, POOL_MAX_PER_HOST, POOL_IDLE_TIMEOUT)
+    async_upstream_pool.configure(POOL_MAX_IDLE, POOL_MAX_PER_HOST, POOL_IDLE_TIMEOUT)
+    DNS_TTL = args.dns_ttl
+    DNS_NEGATIVE_TTL = args.dns_negative_ttl
+    HAPPY_EYEBALLS_DELAY = args.happy_eyeballs_delay
+    resolver.configure(DNS_TTL, DNS_NEGATIVE_TTL, DNS_CACHE_SIZE)
+    return args
+
+# header fields by lowercase name. Lookups are plain dict lookups; a field that
+# repeats (Set-Cookie, or a list header sent twice) keeps every value, in order, in
+# repeats and looks up as the values joined with ', ' (RFC 9110 section 5.3), while
+# items() yields each field separately so they are forwarded and cached unchanged
+class Headers(dict):
+    # shared and never modified: an instance gets its own on the first repeated field
+    repeats: Dict[str, list] = {}
+
+    @classmethod
+    def from_fields(cls, fields) -> 'Headers':
+        headers = cls()
+        for name, value in fields:
+            headers.add(name, value)
+        return headers
+
+    def add(self, name: str, value: str):
+        if name not in self:
+            dict.__setitem__(self, name, value)
+            return
+        if not self.repeats:
+            self.repeats = {}
+        values = self.repeats.get(name)
+        if values is None:
+            values = self.repeats[name] = [dict.__getitem__(self, name)]
+        values.append(value)
+        dict.__setitem__(self, name, ', '.join(values))
+
+    def get_all(self, name: str) -> list:
+        if name in self.repeats:
+            return list(self.repeats[name])
+        return [self[name]] if name in self else []
+
+    def __setitem__(self, name: str, value: str):
+        self.repeats.pop(name, None)
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name: str):
+        self.repeats.pop(name, None)
+        dict.__delitem__(self, name)
+
+    def pop(self, name: str, *default):
+        self.repeats.pop(name, None)
+        return dict.pop(self, name, *default)
+
+    def items(self):
+        for name, value in dict.items(self):
+            if name in self.repeats:
+                for v in self.repeats[name]:
+                    yield name, v
+            else:
+                yield name, value
+
+    def copy(self) -> 'Headers':
+        other = Headers(self)
+        if self.repeats:
+            other.repeats = {name: list(values) for name, values in self.repeats.items()}
+        return other
+
 # models for http req and res
 class HTTPRequest:
     def __init__(self, method: str, url: str, version: str):
         self.method = method
         self.url = url
         self.version = version
-        self.headers: Dict[str,str] = {}
+        self.headers = Headers()
         self.body: bytes = b''
     def __str__(self) -> str:
         return f"{self.method} {self.url} {self.version}"
@@ -51,93 +290,1244 @@ class HTTPResponse:
         self.version = version
         self.status_code = status_code
         self.reason = reason
-        self.headers: Dict[str,str] = {}
+        self.headers = Headers()
         self.body: bytes = b''
     def __str__(self) -> str:
         return f"{self.version} {self.status_code} {self.reason}"
     
+# headers that depend on the client connection, added per response instead of being stored
+HOP_HEADERS = ('connection', 'proxy-connection')
+
+# parse a Cache-Control header into {directive: argument or None}
+def parse_cache_control(value) -> Dict[str, str]:
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip().strip('"') if arg else None
+    return directives
+
+# seconds since the epoch for an HTTP date, or None if missing or invalid
+def parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+def _delta_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+# true if a shared cache may store this response (RFC 9111 section 3)
+def is_storable(req, res) -> bool:
+    if res.status_code != 200:
+        return False
+    cc = parse_cache_control(res.headers.get('cache-control'))
+    if 'no-store' in cc or 'private' in cc:
+        return False
+    # varies on something other than request headers
+    if '*' in vary_names(res.headers):
+        return False
+    if req is not None:
+        if req.method != 'GET':
+            return False
+        if 'no-store' in parse_cache_control(req.headers.get('cache-control')):
+            return False
+        if 'authorization' in req.headers and not ('public' in cc or 's-maxage' in cc or 'must-revalidate' in cc):
+            return False
+    return True
+
+# seconds a response stays fresh after it was generated (RFC 9111 section 4.2.1)
+def freshness_lifetime(headers) -> float:
+    cc = parse_cache_control(headers.get('cache-control'))
+    if 'no-cache' in cc:
+        return 0
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cc:
+            return _delta_seconds(cc[directive]) or 0
+    date = parse_http_date(headers.get('date')) or time.time()
+    if 'expires' in headers:
+        expires = parse_http_date(headers['expires'])
+        return max(0, expires - date) if expires is not None else 0
+    # heuristic: a tenth of the time since the last modification, at most a day
+    last_modified = parse_http_date(headers.get('last-modified'))
+    if last_modified is not None:
+        return min(max(0, date - last_modified) / 10, 86400)
+    return DEFAULT_TTL
+
+# content codings of cached bodies: compressible text is stored gzipped, sent as
+# stored to clients that accept gzip and decoded for the rest. Smallest body worth
+# compressing, and the most a compressed body may keep of its original size
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_RATIO = 0.9
+
+# decoded copies of the gzip bodies most recently sent to clients without gzip, up
+# to DECODED_CACHE_SIZE bytes or the latest one, so that repeated identity and
+# range hits do not decompress the whole body each time
+DECODED_CACHE_SIZE = 8 * 1024 * 1024
+_decoded: OrderedDict = OrderedDict()
+_decoded_size = 0
+_decoded_lock = threading.Lock()
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/x-javascript',
+                      'application/xml', 'application/xhtml+xml', 'application/rss+xml',
+                      'application/atom+xml', 'image/svg+xml')
+
+def is_compressible(res: HTTPResponse) -> bool:
+    if len(res.body) < COMPRESS_MIN_SIZE or 'content-encoding' in res.headers:
+        return False
+    if 'no-transform' in parse_cache_control(res.headers.get('cache-control')):
+        return False
+    ctype = res.headers.get('content-type', '').split(';', 1)[0].strip().lower()
+    return ctype.startswith('text/') or ctype in COMPRESSIBLE_TYPES or ctype.endswith(('+json', '+xml'))
+
+# Accept-Encoding values seen so far and whether they accept gzip; clients send
+# only a handful of distinct values
+_gzip_accepted: Dict[str, bool] = {}
+
+def accepts_gzip(value) -> bool:
+    if not value:
+        return False
+    accepted = _gzip_accepted.get(value)
+    if accepted is None:
+        qualities = {}
+        for item in value.lower().split(','):
+            coding, _, params = item.partition(';')
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            qualities[coding.strip()] = q
+        q = qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0.0)))
+        accepted = q > 0
+        if len(_gzip_accepted) < 1024:
+            _gzip_accepted[value] = accepted
+    return accepted
+
+# lower-cased header names in a response's Vary
+def vary_names(headers) -> list:
+    return sorted({name.strip().lower() for name in headers.get('vary', '').split(',')} - {''})
+
+# headers for a stored response sent in a coding the origin did not choose: the
+# new length and coding, a weak validator, and Vary: Accept-Encoding for caches
+# further down
+def recoded_headers(headers, coding, size: int) -> Headers:
+    headers = headers.copy()
+    if coding:
+        headers['content-encoding'] = coding
+    else:
+        headers.pop('content-encoding', None)
+    headers['content-length'] = str(size)
+    etag = headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        headers['etag'] = 'W/' + etag
+    return vary_accept_encoding(headers)
+
+def vary_accept_encoding(headers) -> Headers:
+    if 'accept-encoding' not in vary_names(headers):
+        headers = headers.copy()
+        vary = headers.get('vary')
+        headers['vary'] = vary + ', Accept-Encoding' if vary else 'Accept-Encoding'
+    return headers
+
+# status line and headers of a stored response, without connection headers, Age
+# or the blank line
+def stored_head(res: HTTPResponse, headers) -> bytes:
+    status = f"{res.version} {res.status_code} {res.reason}\r\n"
+    hdr_lines = ''.join(f"{k}: {v}\r\n" for k,v in headers.items() if k not in HOP_HEADERS and k != 'age')
+    return (status + hdr_lines).encode('latin-1')
+
+# a cached response kept in wire format: the status line and headers are rendered
+# once on insert, hits send head + age + connection headers + body without rebuilding or copying.
+# compressed means the proxy gzipped the body of the response in res.headers;
+# a gzip body, compressed here or by the origin, is sent under head to clients
+# that accept gzip, and decoded under identity_head for the rest
 class CacheEntry:
-    def __init__(self, res):
+    def __init__(self, res, compressed: bool = False):
         self.res = res
-        self.size = len(res.body) if res.body else 0
+        self.body = res.body or b''
+        self.size = len(self.body)
+        self.head = stored_head(res, res.headers)
+        self.compressed = False
+        self.gzip = res.headers.get('content-encoding', '').strip().lower() == 'gzip'
+        self.identity_head = None
+        if compressed:
+            self._mark_compressed()
 
-cache = OrderedDict()
-cache_size = 0
+        # freshness (RFC 9111 section 4.2)
+        self.stored_at = time.time()
+        self.lifetime = freshness_lifetime(res.headers)
+        date = parse_http_date(res.headers.get('date'))
+        apparent_age = max(0, self.stored_at - date) if date is not None else 0
+        self.initial_age = max(apparent_age, _delta_seconds(res.headers.get('age')) or 0)
+        self.etag = res.headers.get('etag')
+        self.last_modified = res.headers.get('last-modified')
 
-# receive data from socket until a delimiter is found (used to extract HTTP headers)
-def recv_until(sock: socket.socket, delim: bytes = b"\r\n\r\n") -> bytes:
-    buf = bytearray()
-    sock.settimeout(1.0)
-    last_data = time.time()
-    while delim not in buf:
-        try:
-            chunk = sock.recv(4096)
-            if not chunk:
+    def age(self, now: float = None) -> float:
+        return self.initial_age + ((now or time.time()) - self.stored_at)
+
+    # true if the body can go out in a coding the client accepts
+    def codes_for(self, req: HTTPRequest) -> bool:
+        return True
+
+    # true if the entry may answer this request without contacting the origin
+    def satisfies(self, req: HTTPRequest) -> bool:
+        if not self.codes_for(req):
+            return False
+        age = self.age()
+        if 'cache-control' in req.headers or 'pragma' in req.headers:
+            cc = parse_cache_control(req.headers.get('cache-control'))
+            if 'no-cache' in cc or 'no-cache' in req.headers.get('pragma', '').lower():
+                return False
+            if 'max-age' in cc and age > (_delta_seconds(cc['max-age']) or 0):
+                return False
+            if 'min-fresh' in cc and age + (_delta_seconds(cc['min-fresh']) or 0) >= self.lifetime:
+                return False
+        return age < self.lifetime
+
+    def _mark_compressed(self):
+        self.compressed = self.gzip = True
+        self.identity_head = stored_head(self.res, vary_accept_encoding(self.res.headers))
+        self.head = stored_head(self.res, recoded_headers(self.res.headers, 'gzip', self.size))
+
+    # the gzip body decoded, kept among the recently decoded bodies
+    def decoded(self) -> bytes:
+        global _decoded_size
+        with _decoded_lock:
+            body = _decoded.get(self)
+            if body is not None:
+                _decoded.move_to_end(self)
+                return body
+        body = gzip.decompress(self.body)
+        with _decoded_lock:
+            if self not in _decoded:
+                _decoded[self] = body
+                _decoded_size += len(body)
+            # the newest stays even if larger than the budget, for the hit it was decoded for
+            while _decoded_size > DECODED_CACHE_SIZE and len(_decoded) > 1:
+                _, old = _decoded.popitem(last=False)
+                _decoded_size -= len(old)
+        return body
+
+    # true if a hit for req decodes the body: the client does not accept gzip, or it
+    # asks for ranges of a body compressed here
+    def decodes_for(self, req: HTTPRequest) -> bool:
+        if not self.gzip or isinstance(self, DiskEntry):
+            return False
+        return (self.compressed and 'range' in req.headers) or not accepts_gzip(req.headers.get('accept-encoding'))
+
+    # head and body for a client, decoding a gzip body if it does not accept gzip
+    def representation(self, gzip_ok: bool) -> Tuple[bytes, bytes]:
+        if not self.gzip or gzip_ok:
+            return self.head, self.body
+        body = self.decoded()
+        if self.identity_head is None:
+            self.identity_head = stored_head(self.res, recoded_headers(self.res.headers, None, len(body)))
+        return self.identity_head, body
+
+    # everything but the body, as plain values that can be serialised
+    def meta(self) -> dict:
+        return {
+            'version': self.res.version, 'status': self.res.status_code, 'reason': self.res.reason,
+            'headers': list(self.res.headers.items()), 'size': self.size, 'compressed': self.compressed,
+            'stored_at': self.stored_at, 'initial_age': self.initial_age, 'lifetime': self.lifetime,
+        }
+
+    # take the freshness and body coding recorded in meta() instead of starting again
+    def restore(self, meta: dict):
+        self.stored_at = meta['stored_at']
+        self.initial_age = meta['initial_age']
+        self.lifetime = meta['lifetime']
+        if meta.get('compressed') and not self.compressed:
+            self._mark_compressed()
+        return self
+
+# the response described by CacheEntry.meta(), with the given body
+def response_from_meta(meta: dict, body: bytes = b'') -> HTTPResponse:
+    res = HTTPResponse(meta['version'], meta['status'], meta['reason'])
+    res.headers = Headers.from_fields(meta['headers'])
+    res.body = body
+    return res
+
+# an entry whose body is a file in the disk cache, hits send it with sendfile
+class DiskEntry(CacheEntry):
+    def __init__(self, res, path: str, size: int, compressed: bool = False):
+        super().__init__(res)
+        self.path = path
+        self.size = size
+        if compressed:
+            self._mark_compressed()
+
+    def open_body(self):
+        return open(self.path, 'rb')
+
+    # the file is sent as it is, so a gzip body only answers clients that accept gzip
+    def codes_for(self, req: HTTPRequest) -> bool:
+        return not self.gzip or accepts_gzip(req.headers.get('accept-encoding'))
+
+    # a memory entry with the same response, read through a mapping of the file
+    def load(self) -> CacheEntry:
+        body = b''
+        if self.size:
+            with self.open_body() as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                body = bytes(mm)
+        meta = self.meta()
+        return CacheEntry(response_from_meta(meta, body)).restore(meta)
+
+# eviction policies: each one holds the entries of one shard, under the shard's
+# lock, and picks which of them goes when the cache is over its byte budget.
+# budget is the shard's share of that budget; evict() returns (key, entry) or
+# None when the shard is empty
+
+# least recently used first
+class LRUPolicy:
+    # whether the shard that grew evicts before the others
+    EVICT_LOCALLY = False
+
+    def __init__(self, budget: int, sketch=None):
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    # store entry under key, returns the entry it replaced
+    def put(self, key: str, entry):
+        old = self.entries.pop(key, None)
+        self.entries[key] = entry
+        return old
+
+    def evict(self):
+        return self.entries.popitem(last=False) if self.entries else None
+
+# Greedy-Dual-Size-Frequency: an entry's priority is the clock plus its hits
+# divided by its size, the lowest priority goes first and sets the clock, so
+# large objects need proportionally more hits to stay and entries that stop
+# being used age out as the clock passes them
+class GDSFPolicy:
+    EVICT_LOCALLY = False
+
+    def __init__(self, budget: int, sketch=None):
+        self.entries: Dict[str, CacheEntry] = {}
+        self.priority: Dict[str, Tuple[float, int]] = {}   # key -> (priority, hits)
+        self.heap = []                                     # (priority, key), stale pairs skipped
+        self.clock = 0.0
+
+    def _set_priority(self, key: str, size: int, hits: int):
+        priority = self.clock + hits / max(size, 1)
+        self.priority[key] = (priority, hits)
+        heapq.heappush(self.heap, (priority, key))
+        # every hit leaves a stale pair behind, rebuild before they dominate
+        if len(self.heap) > 2 * len(self.priority) + 64:
+            self.heap = [(p, k) for k, (p, _) in self.priority.items()]
+            heapq.heapify(self.heap)
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self._set_priority(key, entry.size, self.priority[key][1] + 1)
+        return entry
+
+    def put(self, key: str, entry):
+        old = self.entries.get(key)
+        self.entries[key] = entry
+        self._set_priority(key, entry.size, self.priority[key][1] + 1 if old is not None else 1)
+        return old
+
+    def evict(self):
+        while self.heap:
+            priority, key = heapq.heappop(self.heap)
+            if self.priority.get(key, (None,))[0] == priority:
+                del self.priority[key]
+                self.clock = priority
+                return key, self.entries.pop(key)
+        return None
+
+# 4-bit count-min sketch of how often keys were requested, shared by the shards
+# of a tinylfu cache; all counters are halved after 10 increments per counter so
+# old popularity fades. Updates are not locked, a lost increment only makes an
+# estimate slightly low
+class FrequencySketch:
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+    HALVE = bytes(i >> 1 for i in range(256))
+
+    def __init__(self, width: int):
+        bits = max(width - 1, 1).bit_length()
+        self.shift = 64 - bits
+        self.rows = [bytearray(1 << bits) for _ in self.SEEDS]
+        self.sample = 10 << bits
+        self.additions = 0
+
+    def _slots(self, key: str):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        shift = self.shift
+        return [((h * seed) & 0xFFFFFFFFFFFFFFFF) >> shift for seed in self.SEEDS]
+
+    def increment(self, key: str):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        shift = self.shift
+        for row, seed in zip(self.rows, self.SEEDS):
+            i = ((h * seed) & 0xFFFFFFFFFFFFFFFF) >> shift
+            if row[i] < 15:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample:
+            self.additions //= 2
+            for row in self.rows:
+                row[:] = row.translate(self.HALVE)
+
+    def frequency(self, key: str) -> int:
+        return min(row[i] for row, i in zip(self.rows, self._slots(key)))
+
+# W-TinyLFU: new entries go to a small LRU window and leave it for the main
+# segments; once those are full they leave as candidates instead, and when
+# space is needed a candidate is kept only if it has been requested more often
+# than the probation victim it would replace, so a scan of one-off objects
+# cannot flush the popular ones. Entries move from probation to the protected
+# segment when hit again
+class TinyLFUPolicy:
+    WINDOW = 0.01       # share of the budget for the window
+    PROTECTED = 0.8     # share of the rest for the protected segment
+    # a new entry is judged in its own shard, evicting round robin would take
+    # unjudged victims from the other shards first
+    EVICT_LOCALLY = True
+
+    def __init__(self, budget: int, sketch: FrequencySketch):
+        self.entries: Dict[str, CacheEntry] = {}
+        self.sketch = sketch
+        # key -> size, least recent first
+        self.window = OrderedDict()
+        self.candidates = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.window_max = budget * self.WINDOW
+        self.main_max = budget - self.window_max
+        self.protected_max = self.main_max * self.PROTECTED
+        self.window_bytes = 0
+        self.main_bytes = 0         # probation and protected
+        self.protected_bytes = 0
+
+    def get(self, key: str):
+        # misses count too, a candidate's frequency includes its earlier misses
+        self.sketch.increment(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if key in self.probation:
+            self.protected[key] = self.probation.pop(key)
+            self.protected_bytes += entry.size
+            # demote the least recent protected entries back to probation
+            while self.protected_bytes > self.protected_max and len(self.protected) > 1:
+                demoted, size = self.protected.popitem(last=False)
+                self.protected_bytes -= size
+                self.probation[demoted] = size
+        else:
+            for segment in (self.window, self.protected, self.candidates):
+                if key in segment:
+                    segment.move_to_end(key)
+                    break
+        return entry
+
+    def _remove(self, key: str):
+        for segment in (self.window, self.candidates, self.probation, self.protected):
+            size = segment.pop(key, None)
+            if size is not None:
                 break
-            buf.extend(chunk)
-            last_data = time.time()
-        except socket.timeout:
-            if time.time() - last_data > TIMEOUT:
-                raise
-            continue
-    return bytes(buf)
-
-# receive exact number of bytes from socket (used to read req/res body after we know Content-Length)
-def recv_exact(sock: socket.socket, length: int) -> bytes:
-    buf = bytearray()
-    sock.settimeout(1.0)
-    last_data = time.time()
-    while len(buf) < length:
+        if segment is self.window:
+            self.window_bytes -= size
+        elif segment is not self.candidates:
+            self.main_bytes -= size
+            if segment is self.protected:
+                self.protected_bytes -= size
+
+    def put(self, key: str, entry):
+        old = self.entries.get(key)
+        if old is not None:
+            self._remove(key)
+        self.entries[key] = entry
+        self.window[key] = entry.size
+        self.window_bytes += entry.size
+        while self.window_bytes > self.window_max and self.window:
+            moved, size = self.window.popitem(last=False)
+            self.window_bytes -= size
+            if self.main_bytes + size <= self.main_max:
+                self._admit(moved, size)
+            else:
+                self.candidates[moved] = size
+        return old
+
+    def _admit(self, key: str, size: int):
+        self.probation[key] = size
+        self.main_bytes += size
+
+    def _evict_key(self, key: str):
+        self._remove(key)
+        return key, self.entries.pop(key)
+
+    def evict(self):
+        while self.candidates:
+            candidate = next(iter(self.candidates))
+            main = self.probation or self.protected
+            if not main:
+                self._admit(candidate, self.candidates.pop(candidate))
+                continue
+            victim = next(iter(main))
+            if self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+                self._admit(candidate, self.candidates.pop(candidate))
+                return self._evict_key(victim)
+            return self._evict_key(candidate)
+        for segment in (self.probation, self.protected, self.window):
+            if segment:
+                return self._evict_key(next(iter(segment)))
+        return None
+
+EVICTION_POLICIES = {'lru': LRUPolicy, 'gdsf': GDSFPolicy, 'tinylfu': TinyLFUPolicy}
+
+# one independently locked segment of the cache
+class _Shard:
+    def __init__(self, policy):
+        self.policy = policy
+        self.lock = threading.Lock()
+
+# object cache split into shards by hash of the normalised URL, so hits on
+# different URLs do not contend; the byte budget is enforced across all shards,
+# and the eviction policy orders the entries within each shard
+class ShardedCache:
+    def __init__(self, max_bytes: int, shards: int = CACHE_SHARDS, policy: str = 'lru'):
+        self.max_bytes = max_bytes
+        self.policy = policy
+        # sized for one counter per 4 KiB of budget
+        sketch = FrequencySketch(max_bytes // 4096) if policy == 'tinylfu' else None
+        self.shards = [_Shard(EVICTION_POLICIES[policy](max_bytes // shards, sketch)) for _ in range(shards)]
+        self.size = 0
+        self.size_lock = threading.Lock()
+        self.cursor = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        # called with (key, entry) for every entry evicted to make room
+        self.on_evict = None
+
+    def _shard(self, key: str) -> _Shard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key: str):
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.policy.get(key)
+
+    def put(self, key: str, entry: CacheEntry):
+        if entry.size > self.max_bytes:
+            return
+        shard = self._shard(key)
+        with shard.lock:
+            old = shard.policy.put(key, entry)
+        with self.size_lock:
+            self.size += entry.size - (old.size if old else 0)
+            over = self.size > self.max_bytes
+        if over:
+            self._evict(shard if shard.policy.EVICT_LOCALLY else None)
+
+    # drop entries chosen by the policy until the cache fits its budget, taking one
+    # from each shard in turn so eviction approximates a policy over the whole
+    # cache; a first shard given is emptied of victims before the others are asked
+    def _evict(self, first: _Shard = None):
+        idle_rounds = 0
+        while idle_rounds < len(self.shards):
+            with self.size_lock:
+                if self.size <= self.max_bytes:
+                    return
+                shard = first
+                if shard is None:
+                    shard = self.shards[self.cursor]
+                    self.cursor = (self.cursor + 1) % len(self.shards)
+            with shard.lock:
+                evicted = shard.policy.evict()
+            if evicted is None:
+                if first is None:
+                    idle_rounds += 1
+                first = None
+                continue
+            key, old_entry = evicted
+            idle_rounds = 0
+            with self.size_lock:
+                self.size -= old_entry.size
+                self.evictions += 1
+                self.evicted_bytes += old_entry.size
+            if self.on_evict is not None:
+                self.on_evict(key, old_entry)
+
+    # (key, entry) pairs of every shard, copied under the shard's lock, in the
+    # policy's order; LRU shards list their least recently used entry first
+    def items(self) -> list:
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items.extend(shard.policy.entries.items())
+        return items
+
+cache = ShardedCache(MAX_CACHE_SIZE, CACHE_SHARDS, EVICTION)
+
+# framing for disk index records and cache process messages: an op byte and a payload length
+_RECORD = struct.Struct('!cI')
+# demoted entries waiting for the writer thread, further demotions are dropped when full
+DEMOTE_QUEUE = 64
+
+# second cache tier in a directory: one file per body, named by the hash of the
+# URL, and an append-only index of heads and freshness that is compacted when it
+# is loaded, so the tier survives restarts. Memory evictions are written here by
+# a background thread, and responses too large for memory are spilled here while
+# they stream. LRU within its own byte budget.
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int, max_object_size: int):
+        os.makedirs(directory, exist_ok=True)
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(directory, 'index')
+        self._load()
+        self.index = open(self.index_path, 'ab')
+        self.pending = queue.Queue(DEMOTE_QUEUE)
+        threading.Thread(target=self._writer, name='disk-cache', daemon=True).start()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.dir, hashlib.sha1(key.encode()).hexdigest() + '.body')
+
+    # replay the index, keep entries whose body file is intact, rewrite it compacted
+    def _load(self):
+        metas = OrderedDict()
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        pos = 0
+        while pos + _RECORD.size <= len(data):
+            op, length = _RECORD.unpack_from(data, pos)
+            pos += _RECORD.size
+            try:
+                payload = json.loads(data[pos:pos+length])
+            except ValueError:
+                break   # torn write at the end
+            pos += length
+            metas.pop(payload['key'], None)
+            if op == b'P':
+                metas[payload['key']] = payload
+
+        for key, meta in metas.items():
+            path = self._path(key)
+            try:
+                if os.path.getsize(path) != meta['size']:
+                    continue
+            except OSError:
+                continue
+            self.entries[key] = DiskEntry(response_from_meta(meta), path, meta['size']).restore(meta)
+            self.size += meta['size']
+        while self.size > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.size -= old.size
+
+        # drop bodies no longer in the index and spills cut short by a restart
+        kept = {entry.path for entry in self.entries.values()}
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            if name.endswith('.tmp') or (name.endswith('.body') and path not in kept):
+                os.unlink(path)
+
+        tmp = self.index_path + '.new'
+        with open(tmp, 'wb') as f:
+            for key, entry in self.entries.items():
+                f.write(self._record(b'P', key, entry.meta()))
+        os.replace(tmp, self.index_path)
+
+    def _record(self, op: bytes, key: str, meta: dict = None) -> bytes:
+        payload = dict(meta or {}, key=key)
+        payload = json.dumps(payload, separators=(',', ':')).encode()
+        return _RECORD.pack(op, len(payload)) + payload
+
+    def put(self, key: str, entry: DiskEntry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = entry
+            self.size += entry.size
+            self.index.write(self._record(b'P', key, entry.meta()))
+            while self.size > self.max_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self.size -= old.size
+                try:
+                    os.unlink(old.path)
+                except OSError:
+                    pass
+                self.index.write(self._record(b'D', old_key))
+            self.index.flush()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        return entry
+
+    def accepts(self, size: int) -> bool:
+        return size <= self.max_object_size
+
+    # queue an entry evicted from memory, unless this version is already on disk
+    def demote(self, key: str, entry: CacheEntry):
+        if not self.accepts(entry.size):
+            return
+        on_disk = self.get(key)
+        if on_disk is not None and on_disk.stored_at == entry.stored_at:
+            return
+        try:
+            self.pending.put_nowait((key, entry))
+        except queue.Full:
+            pass
+
+    def _writer(self):
+        while True:
+            key, entry = self.pending.get()
+            try:
+                with self.spill_file() as f:
+                    f.write(entry.body)
+                self.adopt(key, entry.meta(), f.name)
+            except OSError as e:
+                print(f"Disk cache write failed: {e}")
+
+    # a temporary file in the cache directory for a body being written
+    def spill_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.dir, suffix='.tmp', delete=False)
+
+    # move a completely written body file into the cache, returns its entry
+    def adopt(self, key: str, meta: dict, tmp_path: str) -> DiskEntry:
+        path = self._path(key)
+        os.replace(tmp_path, path)
+        entry = DiskEntry(response_from_meta(meta), path, meta['size']).restore(meta)
+        self.put(key, entry)
+        return entry
+
+disk_cache = None
+
+# open the disk tier below the memory cache, in the process that owns the cache
+def open_disk_cache():
+    global disk_cache
+    disk_cache = DiskCache(DISK_CACHE_DIR, DISK_CACHE_SIZE, DISK_MAX_OBJECT_SIZE)
+    cache.on_evict = disk_cache.demote
+
+# an origin fetch in progress for one URL, other requesters wait for its result
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.res = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    # publish the leader's cacheable response, or None if there is nothing to share
+    def finish(self, res):
+        with self.lock:
+            self.res = res
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(res)
+
+    def wait(self, timeout: float):
+        self.done.wait(timeout)
+        return self.res
+
+    async def wait_async(self, timeout: float):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        def resolve(res):
+            loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(res))
+        with self.lock:
+            if self.done.is_set():
+                return self.res
+            self.callbacks.append(resolve)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+# single-flight coalescing of concurrent cache misses on the same URL
+class Coalescer:
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.lock = threading.Lock()
+
+    # returns (flight, True) for the first requester, who must fetch and finish it
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    def finish(self, key: str, flight: Flight, res):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.finish(res)
+
+coalescer = Coalescer()
+
+# true if an idle pooled socket has not been closed or sent unexpected data
+def _socket_idle_ok(sock: socket.socket) -> bool:
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+# keep-alive connections to origins, shared by all client threads
+class UpstreamPool:
+    def __init__(self, max_idle: int, max_per_host: int, idle_timeout: float,
+                 is_ok=_socket_idle_ok, close=lambda conn: conn.close()):
+        self.idle: Dict[Tuple[str,int], list] = {}
+        self.idle_count = 0
+        self.is_ok = is_ok
+        self.close = close
+        self.lock = threading.Lock()
+        self.configure(max_idle, max_per_host, idle_timeout)
+
+    def configure(self, max_idle: int, max_per_host: int, idle_timeout: float):
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+
+    # take the most recently used live connection to host:port, or None
+    def acquire(self, host: str, port: int):
+        key = (host.lower(), port)
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self.lock:
+            conns = self.idle.get(key)
+            while conns:
+                candidate, released = conns.pop()
+                self.idle_count -= 1
+                if now - released <= self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+            if conns == []:
+                del self.idle[key]
+        for old in stale:
+            self.close(old)
+        if conn is not None and not self.is_ok(conn):
+            self.close(conn)
+            return None
+        return conn
+
+    # return a connection after a complete response, closes it if the pool is full
+    def release(self, host: str, port: int, conn):
+        key = (host.lower(), port)
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_per_host and self.idle_count < self.max_idle:
+                conns.append((conn, time.monotonic()))
+                self.idle_count += 1
+                return
+            if not conns:
+                del self.idle[key]
+        self.close(conn)
+
+upstream_pool = UpstreamPool(POOL_MAX_IDLE, POOL_MAX_PER_HOST, POOL_IDLE_TIMEOUT)
+
+# order addresses from getaddrinfo for connecting, alternating between address
+# families so one broken family costs a single attempt, as in RFC 8305
+def _interleave(infos) -> tuple:
+    families: Dict[int, list] = {}
+    for family, _, _, _, sockaddr in infos:
+        families.setdefault(family, []).append((family, sockaddr))
+    ordered = []
+    queues = list(families.values())
+    while queues:
+        ordered += [q.pop(0) for q in queues]
+        queues = [q for q in queues if q]
+    return tuple(ordered)
+
+# origin addresses by (host, port), shared by all clients; an answer is reused
+# for ttl seconds and a failure for negative_ttl, and concurrent lookups of the
+# same name share one getaddrinfo call
+class Resolver:
+    def __init__(self, ttl: float, negative_ttl: float, max_entries: int):
+        # (host, port) -> (expiry, addresses or the gaierror)
+        self.entries = OrderedDict()
+        self.lookups = Coalescer()
+        self.lock = threading.Lock()
+        self.configure(ttl, negative_ttl, max_entries)
+
+    def configure(self, ttl: float, negative_ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+    def cached(self, key: Tuple[str, int]):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return item[1]
+
+    # the blocking lookup, run by the first requester of a name; the flight is
+    # finished whatever happens, with no result if the lookup failed unexpectedly
+    def _lookup(self, key: Tuple[str, int], flight: Flight):
+        start = time.perf_counter()
+        result = None
         try:
-            chunk = sock.recv(length - len(buf))
-            if not chunk:
+            try:
+                result = _interleave(socket.getaddrinfo(key[0], key[1], type=socket.SOCK_STREAM))
+                ttl = self.ttl
+            except socket.gaierror as e:
+                result, ttl = e, self.negative_ttl
+            except UnicodeError:
+                # a name that cannot be encoded fails like an unknown one
+                result, ttl = socket.gaierror(socket.EAI_NONAME, "invalid host name"), self.negative_ttl
+            stats.observe('dns_lookup', time.perf_counter() - start)
+            stats.count('dns_lookups')
+            if ttl > 0:
+                with self.lock:
+                    self.entries[key] = (time.monotonic() + ttl, result)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+            return result
+        finally:
+            self.lookups.finish(key, flight, result)
+
+    @staticmethod
+    def _addresses(result) -> tuple:
+        if isinstance(result, socket.gaierror):
+            # a new exception each time, raising a shared one would grow its traceback
+            raise socket.gaierror(*result.args)
+        return result
+
+    # addresses to try in order as (family, sockaddr); raises socket.gaierror if the
+    # name does not resolve, socket.timeout if another thread's lookup takes too long
+    def resolve(self, host: str, port: int) -> tuple:
+        key = (host.lower(), port)
+        result = self.cached(key)
+        if result is not None:
+            stats.count('dns_hits')
+            return self._addresses(result)
+        flight, leader = self.lookups.join(key)
+        if leader:
+            return self._addresses(self._lookup(key, flight))
+        result = flight.wait(TIMEOUT)
+        if result is None:
+            raise socket.timeout("timed out resolving " + host)
+        return self._addresses(result)
+
+    # resolve on the event loop, the lookup itself runs in the default executor
+    async def resolve_async(self, host: str, port: int) -> tuple:
+        key = (host.lower(), port)
+        result = self.cached(key)
+        if result is not None:
+            stats.count('dns_hits')
+            return self._addresses(result)
+        flight, leader = self.lookups.join(key)
+        if leader:
+            # awaited so that an unexpected failure reaches this requester, as in resolve()
+            lookup = asyncio.get_running_loop().run_in_executor(None, self._lookup, key, flight)
+            return self._addresses(await asyncio.wait_for(lookup, TIMEOUT))
+        result = await flight.wait_async(TIMEOUT)
+        if result is None:
+            raise asyncio.TimeoutError
+        return self._addresses(result)
+
+resolver = Resolver(DNS_TTL, DNS_NEGATIVE_TTL, DNS_CACHE_SIZE)
+
+# requests that may be retried on a fresh connection when a pooled one turns out to be dead
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+# largest request or response head accepted
+MAX_HEAD = 64 * 1024
+
+class HeadTooLarge(ValueError):
+    pass
+
+# read size for relaying bodies, bounds memory per streamed response
+RELAY_CHUNK = 64 * 1024
+
+# receive buffer allocated once per connection, grown only for a head that does not fit
+RECV_BUFFER = RELAY_CHUNK
+
+# longest chunk-size or trailer line accepted
+MAX_LINE = 8192
+
+# finds the end of a chunk line in bytes or in a memoryview, which has no find()
+_LINE_END = re.compile(b'\n')
+
+# incremental HTTP/1.1 message body decoder, independent of how the bytes are received
+# framing is 'none', 'length', 'chunked' or 'close'; feed() returns decoded body pieces as
+# memoryviews into the data passed in, bytes past the end of the message are left in unused
+class BodyDecoder:
+    def __init__(self, framing: str, length: int = 0):
+        if length < 0:
+            raise ValueError("negative content-length")
+        self.framing = framing
+        self.remaining = length     # bytes left in the body, or in the current chunk
+        self.trailers = []
+        self.unused = b''
+        self.done = framing == 'none' or (framing == 'length' and length == 0)
+        self._state = 'size'        # chunked only: 'size', 'data', 'data_end' or 'trailer'
+        self._line = bytearray()
+
+    # how much to read next without consuming past the message:
+    # a byte count, 0 for a single line, or None for any amount
+    def wanted(self):
+        if self.framing == 'close':
+            return None
+        if self.framing == 'length' or self._state == 'data':
+            return self.remaining
+        return 0
+
+    def feed(self, data: bytes) -> list:
+        if self.done:
+            self.unused += data
+            return []
+        view = memoryview(data)
+        if self.framing == 'close':
+            return [view] if data else []
+        if self.framing == 'length':
+            take = min(self.remaining, len(view))
+            self.remaining -= take
+            if self.remaining == 0:
+                self.done = True
+                self.unused = bytes(view[take:])
+            return [view[:take]] if take else []
+
+        # chunked
+        pieces = []
+        pos, end = 0, len(view)
+        while pos < end and not self.done:
+            if self._state == 'data':
+                take = min(self.remaining, end - pos)
+                pieces.append(view[pos:pos+take])
+                pos += take
+                self.remaining -= take
+                if self.remaining == 0:
+                    self._state = 'data_end'
+                continue
+            # every other state consumes one line
+            match = _LINE_END.search(data, pos)
+            if match is None:
+                self._line += view[pos:]
+                if len(self._line) > MAX_LINE:
+                    raise ValueError("chunk line too long")
                 break
-            buf.extend(chunk)
-            last_data = time.time()
-        except socket.timeout:
-            if time.time() - last_data > TIMEOUT:
-                raise
-            continue
-    return bytes(buf)
+            idx = match.start()
+            self._line += view[pos:idx+1]
+            pos = idx + 1
+            line = bytes(self._line[:-1])
+            self._line.clear()
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if self._state == 'size':
+                size = int(line.split(b';',1)[0], 16)
+                if size < 0:
+                    raise ValueError("negative chunk size")
+                if size == 0:
+                    self._state = 'trailer'
+                else:
+                    self.remaining = size
+                    self._state = 'data'
+            elif self._state == 'data_end':
+                if line:
+                    raise ValueError("malformed chunk")
+                self._state = 'size'
+            elif line:
+                self.trailers.append(line)
+            else:
+                self.done = True
+        if self.done:
+            self.unused = bytes(view[pos:])
+        return pieces
 
-# split raw HTTP request/response into head and body
-def _split_head_body(raw: bytes) -> Tuple[bytes,bytes]:
-    parts = raw.split(b"\r\n\r\n", 1)
-    if len(parts) == 2:
-        return parts[0], parts[1]
-    return parts[0], b''
+    # the peer closed the connection, raises ValueError if the body was cut short
+    def eof(self):
+        if self.framing == 'close' or (self._state == 'trailer' and not self._line):
+            self.done = True
+        if not self.done:
+            raise ValueError("closed unexpectedly")
 
-# parse http req into object
-def parse_http_request(raw: bytes) -> HTTPRequest:
-    head, body = _split_head_body(raw)
-    parts = head.split(b"\r\n", 1)
-    if len(parts) < 2:
-        raise ValueError("malformed request head")
-    request_line, header_block = parts
-    method, url, version = request_line.decode('ascii').split(' ',2)
+# buffered reader over a socket. Everything is received with recv_into one buffer
+# allocated per connection and handed out as memoryviews into it, which stay valid
+# only until the next read. Bytes past the end of a message (the next pipelined
+# request) stay buffered for the next read_head()
+class SocketReader:
+    def __init__(self, sock: socket.socket = None, pending: bytes = b'', size: int = RECV_BUFFER):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.reset(sock)
+        self.unread(pending)
+
+    # point the reader at another socket, dropping anything buffered
+    def reset(self, sock: socket.socket):
+        self.sock = sock
+        self.start = self.end = 0   # the buffered bytes are buf[start:end]
+        self.scanned = 0            # buf[start:scanned] has been searched for a blank line
+
+    def buffered(self) -> int:
+        return self.end - self.start
+
+    # receive into the space after end, moving the buffered bytes to the front
+    # or doubling the buffer first if it is full; returns 0 at EOF
+    def _fill(self) -> int:
+        if self.end == len(self.buf):
+            n = self.end - self.start
+            if self.start:
+                self.buf[:n] = self.buf[self.start:self.end]
+            else:
+                self.buf = self.buf + bytearray(len(self.buf))
+                self.view = memoryview(self.buf)
+            self.scanned -= self.start
+            self.start, self.end = 0, n
+        got = self.sock.recv_into(self.view[self.end:])
+        self.end += got
+        return got
+
+    # whether a whole head is buffered already, e.g. a request the client pipelined
+    def has_head(self) -> bool:
+        # back up three bytes in case the blank line straddles two reads
+        return self.buf.find(b"\r\n\r\n", max(self.start, self.scanned - 3), self.end) >= 0
+
+    # receive until a whole head is buffered and return its offset in buf, or -1 if
+    # the peer closed between messages. Only newly arrived bytes are searched
+    def read_head(self) -> int:
+        while True:
+            if self.has_head():
+                return self.start
+            self.scanned = self.end
+            if self.end - self.start > MAX_HEAD:
+                raise HeadTooLarge("head larger than %d bytes" % MAX_HEAD)
+            if not self._fill():
+                if self.start == self.end:
+                    return -1
+                raise ValueError("closed in the middle of a head")
+
+    # mark buf up to pos as used, e.g. the head just parsed
+    def consume(self, pos: int):
+        self.start = self.scanned = pos
+
+    # return buffered bytes if there are any, otherwise receive once; empty at EOF
+    def read_some(self, max_bytes: int = RELAY_CHUNK) -> memoryview:
+        if self.start == self.end:
+            self.start = self.scanned = 0
+            self.end = self.sock.recv_into(self.view[:max_bytes])
+        data = self.view[self.start:self.end]
+        self.start = self.scanned = self.end
+        return data
+
+    # everything buffered, copied out, leaving the buffer empty
+    def drain(self) -> bytes:
+        data = bytes(self.view[self.start:self.end])
+        self.start = self.scanned = self.end
+        return data
+
+    # push back bytes not used from the last read, normally the tail of it still in buf
+    def unread(self, data: bytes):
+        n = len(data)
+        if not n:
+            return
+        if n <= self.start and self.view[self.start - n:self.start] == data:
+            self.start = self.scanned = self.start - n
+            return
+        data = bytes(data) + self.drain()
+        if len(data) > len(self.buf):
+            self.buf = bytearray(len(data))
+            self.view = memoryview(self.buf)
+        self.buf[:len(data)] = data
+        self.start = self.scanned = 0
+        self.end = len(data)
+
+# yield the decoded body of a message as it arrives
+def iter_body(reader: SocketReader, decoder: BodyDecoder):
+    while not decoder.done:
+        data = reader.read_some()
+        if not data:
+            decoder.eof()
+            break
+        yield from decoder.feed(data)
+    reader.unread(decoder.unused)
+
+# parse the head at buf[start:] in one pass: the blank line is found once within
+# MAX_HEAD, only the head is decoded and split into fields, nothing after it is
+# copied. Returns (start line, headers, offset of the body in buf)
+def _parse_head(buf, start: int = 0):
+    end = buf.find(b"\r\n\r\n", start, start + MAX_HEAD + 4)
+    if end < 0:
+        if len(buf) - start > MAX_HEAD:
+            raise HeadTooLarge("head larger than %d bytes" % MAX_HEAD)
+        raise ValueError("incomplete head")
+    lines = buf[start:end].decode('latin-1').split("\r\n")
+    fields = {}
+    for line in lines[1:]:
+        # a line without a colon fails to unpack, which is a ValueError as well
+        name, value = line.split(':', 1)
+        fields[name.lower()] = value.strip()
+    # field names are tokens: never empty, no whitespace (so none before the colon)
+    names = ''.join(fields)
+    if '' in fields or ' ' in names or '\t' in names:
+        raise ValueError("malformed header field name")
+    if len(fields) == len(lines) - 1:
+        return lines[0], Headers(fields), end + 4
+    # some field repeats, go again keeping every value
+    headers = Headers()
+    for line in lines[1:]:
+        name, value = line.split(':', 1)
+        headers.add(name.lower(), value.strip())
+    return lines[0], headers, end + 4
+
+# parse a request head at buf[start:], returns the request and the offset of its body
+def parse_request_head(buf, start: int = 0) -> Tuple[HTTPRequest, int]:
+    request_line, headers, body_start = _parse_head(buf, start)
+    method, url, version = request_line.split(' ', 2)
     req = HTTPRequest(method, url, version)
-    for line in header_block.decode('ascii').split("\r\n"):
-        if not line: continue
-        key,val = line.split(': ',1)
-        req.headers[key.lower()] = val
-    req.body = body
+    req.headers = headers
+    return req, body_start
+
+# parse a response head at buf[start:], returns the response and the offset of its body
+def parse_response_head(buf, start: int = 0) -> Tuple[HTTPResponse, int]:
+    status_line, headers, body_start = _parse_head(buf, start)
+    parts = status_line.split(' ', 2)
+    if len(parts) < 2:
+        raise ValueError("malformed status line")
+    res = HTTPResponse(parts[0], int(parts[1]), parts[2] if len(parts) > 2 else '')
+    res.headers = headers
+    return res, body_start
+
+# parse http req into object, with whatever follows the head as its body
+def parse_http_request(raw: bytes) -> HTTPRequest:
+    req, body_start = parse_request_head(raw)
+    req.body = bytes(raw[body_start:])
     return req
 
-# parse http res into object
+# parse http res into object, with whatever follows the head as its body
 def parse_http_response(raw: bytes) -> HTTPResponse:
-    head, body = _split_head_body(raw)
-    status_line, header_block = head.split(b"\r\n",1)
-    parts = status_line.decode('ascii').split(' ',2)
-    version = parts[0]
-    code = int(parts[1])
-    reason = parts[2] if len(parts)>2 else ''
-    resp = HTTPResponse(version, code, reason)
-    for line in header_block.decode('ascii').split("\r\n"):
-        if not line: continue
-        key,val = line.split(': ',1)
-        resp.headers[key.lower()] = val
-    resp.body = body
-    return resp
+    res, body_start = parse_response_head(raw)
+    res.body = bytes(raw[body_start:])
+    return res
 
 # split url into host:port and path
 def split_url(url: str) -> Tuple[str,str]:
@@ -149,12 +1539,24 @@ def split_url(url: str) -> Tuple[str,str]:
     path = '/' + parts[1] if len(parts)==2 else '/'
     return host_port, path
 
+# the log timestamp only changes once a second, so format it once a second
+_clf_time = (0, '')
+
+def _clf_timestamp() -> str:
+    global _clf_time
+    now = int(time.time())
+    if _clf_time[0] != now:
+        _clf_time = (now, time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(now)))
+    return _clf_time[1]
+
 # generate a log entry for the cache log
-def generate_clf_entry(req: HTTPRequest, res: HTTPResponse, client_addr: Tuple[str, int], cache_flag: str) -> str:
+# body_bytes overrides the size of res.body for streamed responses
+def generate_clf_entry(req: HTTPRequest, res: HTTPResponse, client_addr: Tuple[str, int], cache_flag: str, body_bytes: int = None) -> str:
     ip, port = client_addr
-    timestamp = time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime())
+    timestamp = _clf_timestamp()
     request_line = f"{req.method} {req.url} {req.version}"
-    body_bytes = len(res.body) if res.body else 0
+    if body_bytes is None:
+        body_bytes = len(res.body) if res.body else 0
 
     return (
         f"{ip} {port} {cache_flag} "
@@ -162,8 +1564,8 @@ def generate_clf_entry(req: HTTPRequest, res: HTTPResponse, client_addr: Tuple[s
         f"{res.status_code} {body_bytes}"
     )
 
-# send error response to client
-def send_error_response(client_conn: socket.socket, version: str, code: int, reason: str, phrase: str):
+# build the bytes of a plain text error response
+def error_response_bytes(version: str, code: int, reason: str, phrase: str) -> bytes:
     body = phrase.encode('ascii')
     hdrs = (
         f"{version} {code} {reason}\r\n"
@@ -172,26 +1574,103 @@ def send_error_response(client_conn: socket.socket, version: str, code: int, rea
         "Connection: close\r\n"
         "\r\n"
     )
-    client_conn.sendall(hdrs.encode('ascii') + body)
+    return hdrs.encode('ascii') + body
 
-def send_log_error_response(client_conn, req, code, reason, phrase, cache_flag='-'):
-    body = phrase.encode('ascii')
-    hdrs = (
-        f"{req.version} {code} {reason}\r\n"
-        "Content-Type: text/plain\r\n"
-        f"Content-Length: {len(body)}\r\n"
-        "Connection: close\r\n"
-        "\r\n"
-    )
-    client_conn.sendall(hdrs.encode('ascii') + body)
+# send error response to client
+def send_error_response(client_conn: socket.socket, version: str, code: int, reason: str, phrase: str):
+    client_conn.sendall(error_response_bytes(version, code, reason, phrase))
+
+# entries taken off the queue and written at once
+LOG_BATCH = 512
+
+# access log written by a background thread: request handlers only queue the
+# formatted entry, the writer prints whole batches and appends them to the log
+# file, which stays open, flushing at most every flush_interval seconds
+class AccessLog:
+    def __init__(self, path: str, max_queue: int, flush_interval: float, overflow: str):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.reported = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def write(self, entry: str):
+        if self.thread is None:
+            self._start()
+        if self.overflow == 'block':
+            self.queue.put(entry)
+            return
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+                self.thread.start()
 
+    def _run(self):
+        # unbuffered append, one write per batch, so worker processes sharing
+        # the file never interleave within a line
+        with open(self.path, 'ab', buffering=0) as log_file:
+            next_flush = time.monotonic() + self.flush_interval
+            closing = False
+            while not closing:
+                batch = []
+                try:
+                    batch.append(self.queue.get(timeout=max(0, next_flush - time.monotonic())))
+                    while len(batch) < LOG_BATCH:
+                        batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    pass
+                if batch and batch[-1] is None:
+                    closing = True
+                    batch.pop()
+                if batch:
+                    text = '\n'.join(batch) + '\n'
+                    sys.stdout.write(text)
+                    log_file.write(text.encode())
+                if closing or time.monotonic() >= next_flush:
+                    if self.overflow == 'count' and self.dropped != self.reported:
+                        print(f"Access log: {self.dropped - self.reported} entries dropped, queue full")
+                        self.reported = self.dropped
+                    sys.stdout.flush()
+                    next_flush = time.monotonic() + self.flush_interval
+
+    # write out everything queued and stop the writer
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(TIMEOUT)
+
+access_log = AccessLog(LOG_FILE, LOG_QUEUE, LOG_FLUSH_INTERVAL, LOG_OVERFLOW)
+
+# print a log entry and append it to the log file
+def log_request(req: HTTPRequest, res: HTTPResponse, client_addr: Tuple[str, int], cache_flag: str, body_bytes: int = None):
+    stats.request(cache_flag, res.status_code, len(res.body) if body_bytes is None else body_bytes)
+    access_log.write(generate_clf_entry(req, res, client_addr, cache_flag, body_bytes))
+
+def _log_error(req, code, reason, phrase, client_addr, cache_flag):
     error_res = HTTPResponse(req.version, code, reason)
-    error_res.body = body
-    entry = generate_clf_entry(req, error_res, client_conn.getpeername(), cache_flag)
-    print(entry)
-    with lock:
-        with open('log.log','a') as f:
-            f.write(entry + "\n")
+    error_res.body = phrase.encode('ascii')
+    log_request(req, error_res, client_addr, cache_flag)
+
+def send_log_error_response(client_conn, req, code, reason, phrase, cache_flag='-'):
+    client_conn.sendall(error_response_bytes(req.version, code, reason, phrase))
+    _log_error(req, code, reason, phrase, peer_address(client_conn), cache_flag)
+
+# a client's address for the log, also once its connection has been reset
+def peer_address(sock: socket.socket) -> Tuple[str, int]:
+    try:
+        return sock.getpeername()[:2]
+    except OSError:
+        return ('-', 0)
 
 def normalise_url(url: str) -> str:
     if url.startswith("http://"):
@@ -216,95 +1695,1177 @@ def normalise_url(url: str) -> str:
     return f"{scheme}://{host}:{port}{path}"
 
 def cache_get(key: str):
-    with lock:
-        entry = cache.pop(key, None)
-        if entry:
-            cache[key] = entry
-            return entry.res
-    return None
-
-def cache_put(key: str, response):
-    global cache_size
-    obj_size = len(response.body)
+    entry = cache.get(key)
+    if entry is None and disk_cache is not None:
+        entry = disk_cache.get(key)
+        # objects that fit in memory move back up, larger ones are served from their file
+        if entry is not None and entry.size <= MAX_OBJECT_SIZE:
+            try:
+                entry = entry.load()
+            except OSError:
+                return None
+            cache.put(key, entry)
+    elif isinstance(entry, DiskEntry) and entry.gzip and entry.size <= MAX_OBJECT_SIZE:
+        # from the cache process's disk tier: a gzip body is decoded in memory
+        try:
+            entry = entry.load()
+        except OSError:
+            return None
+    return entry
 
-    if response.status_code != 200 or obj_size > MAX_OBJECT_SIZE:
-        return
+# secondary keys (RFC 9111 section 4.1): a response with Vary is stored under its
+# URL and the request's values of the headers it names, and the names last seen
+# for each URL give the key to look up for the next request to it. Under
+# --workers the cache process keeps the index for all workers, each worker a
+# copy of the names it has used
+VARY_INDEX_SIZE = 10000
+_vary_index: OrderedDict = OrderedDict()
+_vary_lock = threading.Lock()
 
-    with lock:
-        while cache_size + obj_size > MAX_CACHE_SIZE and cache:
-            old_key, old_entry = cache.popitem(last=False)
-            cache_size -= old_entry.size
-        if obj_size > MAX_CACHE_SIZE:
-            return
-        cache[key] = CacheEntry(response)
-        cache_size += obj_size
+def variant_key(url_key: str, names, headers) -> str:
+    return url_key + ''.join(f"\n{name}: {headers.get(name, '')}" for name in names)
 
-# handle client connection
-def handle_client(client_conn: socket.socket):
-    try:
-        client_conn.settimeout(TIMEOUT)
-        # loop for persistence
-        while True:
-            thread_name = threading.current_thread().name
+# the URL key and Vary names a key was made from
+def variant_names(key: str) -> Tuple[str, tuple]:
+    url_key, *lines = key.split('\n')
+    return url_key, tuple(line.partition(':')[0] for line in lines)
 
-            # read request from client
-            try:
-                req_buf = recv_until(client_conn)
-            except socket.timeout:
-                if VERBOSE:
-                    print("Timeout while receiving request")
-                # return to close the connection
-                return
-            if not req_buf: return
-            head, body = _split_head_body(req_buf)
-            try:
-                req = parse_http_request(req_buf)
-            except ValueError as e:
-                temp = HTTPRequest("GET", "", "HTTP/1.1")
-                send_log_error_response(client_conn, temp, 400, "Bad Request", "malformed request")
-                return
-            # if request contains a body, read it
-            if 'content-length' in req.headers and req.method not in ('GET','HEAD'):
-                total = int(req.headers['content-length'])
-                already = len(body)
-                if total > already:
-                    body += recv_exact(client_conn, total-already)
-                req.body = body
-            else:
-                req.body = b''
+# remember the names responses for url_key vary on, forgetting them if there are none
+def record_vary(url_key: str, names):
+    with _vary_lock:
+        if names:
+            _vary_index[url_key] = tuple(names)
+            _vary_index.move_to_end(url_key)
+            if len(_vary_index) > VARY_INDEX_SIZE:
+                _vary_index.popitem(last=False)
+        else:
+            _vary_index.pop(url_key, None)
 
-            client_conn_hdr = req.headers.get('connection')
-            client_proxy_hdr = req.headers.get('proxy-connection')
+# the key a request's response is looked up under
+def request_cache_key(req: HTTPRequest) -> str:
+    url_key = normalise_url(req.url)
+    if not _vary_index:
+        return url_key
+    with _vary_lock:
+        names = _vary_index.get(url_key)
+    return variant_key(url_key, names, req.headers) if names else url_key
 
-            if req.method != 'CONNECT' and req.headers.get('host') is None:
-                send_log_error_response(client_conn, req, 400, "Bad Request", "no host")
-                return
-            
-            cache_flag = '-'
-            if req.method == 'GET':
-                cache_key = normalise_url(req.url)
-                cached = cache_get(cache_key)
-                if cached:
-                    cache_flag = 'H'
-                    res = cached
-                    status = f"{res.version} {res.status_code} {res.reason}\r\n"
-                    hdrs = ''.join(f"{k}: {v}\r\n" for k,v in res.headers.items())
-                    client_conn.sendall(status.encode('ascii') + hdrs.encode('ascii') + b"\r\n" + res.body)
-                    log_entry = generate_clf_entry(req, res, client_conn.getpeername(), cache_flag)
-                    print(log_entry)
-                    with lock:
-                        with open('log.log', 'a') as log_file:
-                            log_file.write(log_entry + '\n')
-                    continue
-                else:
-                    cache_flag = 'M'
+# the key a request's response is stored under and the entry there or None; a
+# worker's lookup also brings back the cache process's Vary names for the URL, and
+# is made again if they give another key
+def cache_lookup(req: HTTPRequest):
+    key = request_cache_key(req)
+    entry = cache_get(key)
+    if entry is None and isinstance(cache, CacheClient):
+        retry = request_cache_key(req)
+        if retry != key:
+            key, entry = retry, cache_get(retry)
+    return key, entry
 
-            if VERBOSE:
+# the key to store a response to req under, recording the headers it varies on;
+# Accept-Encoding is left out when the proxy chooses the coding for each client
+# itself, which it does for gzip bodies it can decode in memory
+def response_cache_key(url_key: str, res: HTTPResponse, req: HTTPRequest, decodes_gzip: bool = True) -> str:
+    names = vary_names(res.headers)
+    coding = res.headers.get('content-encoding', 'identity').strip().lower()
+    if coding == 'identity' or (coding == 'gzip' and decodes_gzip):
+        names = [name for name in names if name != 'accept-encoding']
+    record_vary(url_key, names)
+    return variant_key(url_key, names, req.headers if req is not None else {}) if names else url_key
+
+# the entry a coalesced request waited for, or None if the leader's response is
+# another variant than the one this request selects
+def coalesced_entry(req: HTTPRequest, key: str, entry):
+    if entry is None or not entry.codes_for(req):
+        return None
+    if request_cache_key(req) == key:
+        return entry
+    _, entry = cache_lookup(req)
+    return entry if entry is not None and entry.satisfies(req) else None
+
+# add the validators of a stale entry to a request, returns the entry if the
+# origin can answer with 304 Not Modified, None if it needs a full response
+def add_validators(req: HTTPRequest, entry):
+    if entry is None or not entry.codes_for(req) or 'if-none-match' in req.headers or 'if-modified-since' in req.headers:
+        return None
+    if not entry.etag and not entry.last_modified:
+        return None
+    if entry.etag:
+        req.headers['if-none-match'] = entry.etag
+    if entry.last_modified:
+        req.headers['if-modified-since'] = entry.last_modified
+    return entry
+
+# update a stored response from a 304 (RFC 9111 section 4.3.4) and store the refreshed entry
+def refresh_entry(key: str, entry: CacheEntry, not_modified: HTTPResponse) -> CacheEntry:
+    res = HTTPResponse(entry.res.version, entry.res.status_code, entry.res.reason)
+    res.headers = entry.res.headers.copy()
+    for k, v in not_modified.headers.items():
+        if k not in HOP_HEADERS and k not in ('content-length', 'transfer-encoding', 'via'):
+            res.headers[k] = v
+    if isinstance(entry, DiskEntry):
+        refreshed = DiskEntry(res, entry.path, entry.size, entry.compressed)
+        (disk_cache or cache).put(key, refreshed)
+        return refreshed
+    res.body = entry.body
+    refreshed = CacheEntry(res, entry.compressed)
+    cache.put(key, refreshed)
+    return refreshed
+
+# store a complete response, returns the new entry or None if it is not cacheable;
+# compressible bodies are kept gzipped when that saves enough
+def cache_put(url_key: str, response, req: HTTPRequest = None):
+    obj_size = len(response.body)
+
+    if not is_storable(req, response) or obj_size > MAX_OBJECT_SIZE:
+        return None
+
+    compressed = False
+    if COMPRESS_LEVEL and is_compressible(response):
+        body = gzip.compress(response.body, COMPRESS_LEVEL, mtime=0)
+        if len(body) <= obj_size * COMPRESS_RATIO:
+            response.body = body
+            compressed = True
+    elif response.headers.get('content-encoding', '').strip().lower() == 'gzip':
+        # gzipped by the origin: clients that do not accept gzip get it decoded
+        try:
+            gzip.decompress(response.body)
+        except (OSError, EOFError, zlib.error):
+            return None
+    entry = CacheEntry(response, compressed)
+    cache.put(response_cache_key(url_key, response, req), entry)
+    return entry
+
+# true if host:port points back at this proxy
+def is_proxy_address(host: str, port: int) -> bool:
+    return host in (HOST, '127.0.0.1', 'localhost') and port == PORT
+
+# rewrite a request for the origin, returns (host, port, bytes to forward);
+# raises ValueError if the port is not a number from 1 to 65535
+def prepare_forward(req: HTTPRequest) -> Tuple[str, int, bytes]:
+    # format headers
+    req.headers.pop('proxy-connection', None)
+    req.headers.pop('connection', None)
+    req.headers['connection'] = 'keep-alive'
+    via = '1.1 z5592060'
+    if 'via' in req.headers:
+        req.headers['via'] += ', ' + via
+    else:
+        req.headers['via'] = via
+
+    # extract the origin form
+    host_port, path = split_url(req.url)
+    if ':' in host_port:
+        host,port_str = host_port.split(':',1)
+        # checked here, getaddrinfo would take a larger port modulo 65536
+        if not (port_str.isascii() and port_str.isdigit()) or not 0 < int(port_str) < 65536:
+            raise ValueError(f"invalid port {port_str!r}")
+        port = int(port_str)
+    else:
+        host = host_port; port = 80
+    req.headers['host'] = host_port
+
+    # rebuild the request line
+    request_line = f"{req.method} {path} {req.version}\r\n"
+    hdrs = ''.join(f"{k}: {v}\r\n" for k,v in req.headers.items())
+    forward_data = (request_line + hdrs + '\r\n').encode('latin-1') + req.body
+    return host, port, forward_data
+
+# true if the origin allows another request on the connection after this response
+def upstream_reusable(res: HTTPResponse) -> bool:
+    conn_hdr = res.headers.get('connection', '').lower()
+    if 'close' in conn_hdr:
+        return False
+    if res.version == 'HTTP/1.0' and 'keep-alive' not in conn_hdr:
+        return False
+    return True
+
+# how the body of a client request is delimited: 'none', 'length' or 'chunked'
+def request_framing(req: HTTPRequest) -> str:
+    if req.headers.get('transfer-encoding', '').lower() == 'chunked':
+        return 'chunked'
+    if 'content-length' in req.headers:
+        return 'length'
+    return 'none'
+
+# decoder for a message body given its framing and headers
+# raises ValueError unless a Content-Length is a non-negative decimal number
+def make_decoder(framing: str, headers) -> BodyDecoder:
+    length = 0
+    if framing == 'length':
+        value = headers['content-length'].strip()
+        if not (value.isascii() and value.isdigit()):
+            raise ValueError(f"invalid content-length {value!r}")
+        length = int(value)
+    return BodyDecoder(framing, length)
+
+# how the body of an origin response is delimited: 'none', 'length', 'chunked' or 'close'
+def response_framing(req: HTTPRequest, res: HTTPResponse) -> str:
+    # if head method or 1xx,204,304 status codes, no body
+    if req.method == 'HEAD' or 100 <= res.status_code < 200 or res.status_code in (204,304):
+        return 'none'
+    if res.headers.get('transfer-encoding', '').lower() == 'chunked':
+        return 'chunked'
+    if 'content-length' in res.headers:
+        return 'length'
+    return 'close'
+
+# re-frames streamed body pieces for the client and keeps a copy for the cache while it fits in MAX_OBJECT_SIZE
+class BodyTee:
+    def __init__(self, req: HTTPRequest, res: HTTPResponse, framing: str):
+        self.res = res
+        self.length = 0
+        # HTTP/1.0 clients cannot take chunked bodies, they get the decoded body delimited by close
+        self.chunked = framing == 'chunked' and req.version != 'HTTP/1.0'
+        self.close_delimited = framing == 'close' or (framing == 'chunked' and not self.chunked)
+        if self.close_delimited:
+            res.headers.pop('transfer-encoding', None)
+            res.headers['connection'] = 'close'
+        self.buf = bytearray() if is_storable(req, res) else None
+        # disk cache file the body goes to once it outgrows MAX_OBJECT_SIZE
+        self.spill = None
+
+    # bytes to send to the client for one piece of decoded body
+    def frame(self, piece: bytes) -> bytes:
+        if not piece:
+            return b''
+        self.length += len(piece)
+        if self.buf is not None:
+            try:
+                self._keep(piece)
+            except OSError:
+                self.discard()
+        if self.chunked:
+            return b'%x\r\n' % len(piece) + piece + b'\r\n'
+        return piece
+
+    # bytes that terminate the body
+    def end(self) -> bytes:
+        return b'0\r\n\r\n' if self.chunked else b''
+
+    def _keep(self, piece: bytes):
+        if self.spill is not None:
+            if disk_cache.accepts(self.length):
+                self.spill.write(piece)
+            else:
+                self.discard()
+        elif len(self.buf) + len(piece) <= MAX_OBJECT_SIZE:
+            self.buf += piece
+        elif disk_cache is not None and disk_cache.accepts(self.length):
+            self.spill = disk_cache.spill_file()
+            self.spill.write(self.buf)
+            self.spill.write(piece)
+            self.buf = bytearray()
+        else:
+            self.buf = None
+
+    # stop keeping the body, removing any partly written spill file
+    def discard(self):
+        self.buf = None
+        if self.spill is not None:
+            self.spill.close()
+            os.unlink(self.spill.name)
+            self.spill = None
+
+    # store the complete body in memory or, if it was spilled, on disk;
+    # returns the new entry or None if the body was not kept
+    def store(self, req: HTTPRequest):
+        if self.buf is None:
+            return None
+        cached = HTTPResponse(self.res.version, self.res.status_code, self.res.reason)
+        cached.headers = self.res.headers.copy()
+        cached.headers.pop('transfer-encoding', None)
+        if self.close_delimited:
+            cached.headers.pop('connection', None)
+        cached.headers['content-length'] = str(self.length)
+        url_key = normalise_url(req.url)
+        if self.spill is None:
+            cached.body = bytes(self.buf)
+            return cache_put(url_key, cached, req)
+        meta = CacheEntry(cached).meta()
+        meta['size'] = self.length
+        spill, self.spill = self.spill, None
+        try:
+            spill.close()
+            # served from the file, so a gzip body is only for clients that accept it
+            key = response_cache_key(url_key, cached, req, decodes_gzip=False)
+            return disk_cache.adopt(key, meta, spill.name)
+        except OSError:
+            os.unlink(spill.name)
+            return None
+
+# connect to each address in turn, raises the last failure if none accepts
+def _connect_each(addrs: tuple) -> socket.socket:
+    for family, sockaddr in addrs:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(TIMEOUT)
+        try:
+            sock.connect(sockaddr)
+            return sock
+        except socket.timeout:
+            sock.close()
+            raise
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
+
+# happy eyeballs: start on the first address and on the next one every
+# HAPPY_EYEBALLS_DELAY seconds, or as soon as an attempt fails, and keep the
+# first connection made
+def _connect_race(addrs: tuple) -> socket.socket:
+    deadline = time.monotonic() + TIMEOUT
+    addrs = list(addrs)
+    sel = selectors.DefaultSelector()
+    next_start = 0
+    error = None
+    try:
+        while True:
+            now = time.monotonic()
+            if addrs and (now >= next_start or not sel.get_map()):
+                family, sockaddr = addrs.pop(0)
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                err = sock.connect_ex(sockaddr)
+                if err in (0, errno.EINPROGRESS):
+                    sel.register(sock, selectors.EVENT_WRITE)
+                    next_start = now + HAPPY_EYEBALLS_DELAY
+                else:
+                    sock.close()
+                    error = OSError(err, os.strerror(err))
+                continue
+            if not sel.get_map():
+                raise error
+            if now >= deadline:
+                raise socket.timeout("timed out")
+            wait = deadline - now
+            if addrs:
+                wait = min(wait, next_start - now)
+            for key, _ in sel.select(wait):
+                sock = key.fileobj
+                sel.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    sock.settimeout(TIMEOUT)
+                    return sock
+                sock.close()
+                error = OSError(err, os.strerror(err))
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+
+# connect to the origin
+def connect_upstream(host: str, port: int) -> socket.socket:
+    addrs = resolver.resolve(host, port)
+    start = time.perf_counter()
+    if len(addrs) > 1 and HAPPY_EYEBALLS_DELAY > 0:
+        server_sock = _connect_race(addrs)
+    else:
+        server_sock = _connect_each(addrs)
+    stats.observe('upstream_connect', time.perf_counter() - start)
+    return server_sock
+
+# send a request to the origin and receive the response head into reader, returns
+# (socket, offset of the head in reader.buf); an idle pooled connection is tried
+# first, a dead one is replaced by a fresh connection
+def forward_upstream(reader: SocketReader, host: str, port: int, method: str, forward_data: bytes) -> Tuple[socket.socket, int]:
+    if method in IDEMPOTENT_METHODS:
+        server_sock = upstream_pool.acquire(host, port)
+        if server_sock is not None:
+            try:
+                server_sock.sendall(forward_data)
+                reader.reset(server_sock)
+                head = reader.read_head()
+                if head >= 0:
+                    stats.count('upstream_reused')
+                    return server_sock, head
+            except socket.timeout:
+                server_sock.close()
+                raise
+            except (OSError, ValueError):
+                # reset, or a broken or oversized head: try again on a fresh connection
+                pass
+            server_sock.close()
+
+    server_sock = connect_upstream(host, port)
+    try:
+        server_sock.sendall(forward_data)
+        reader.reset(server_sock)
+        head = reader.read_head()
+        if head < 0:
+            raise ValueError("closed before the response head")
+        return server_sock, head
+    except BaseException:
+        server_sock.close()
+        raise
+
+# connection header lines and blank line that follow a cached head, for each
+# combination of client Connection / Proxy-Connection values
+_connection_suffixes: Dict[Tuple, Tuple[bytes, bool]] = {}
+
+def connection_suffix(client_conn_hdr, client_proxy_hdr) -> Tuple[bytes, bool]:
+    def norm(value):
+        value = value.lower() if value else None
+        return value if value in ('close', 'keep-alive') else None
+    key = (norm(client_conn_hdr), norm(client_proxy_hdr))
+    suffix = _connection_suffixes.get(key)
+    if suffix is None:
+        res = HTTPResponse('', 0, '')
+        end_conn = apply_connection_headers(res, *key)
+        lines = ''.join(f"{k}: {v}\r\n" for k,v in res.headers.items() if k in HOP_HEADERS)
+        suffix = _connection_suffixes[key] = ((lines + "\r\n").encode('ascii'), end_conn)
+    return suffix
+
+# buffers to send for a cache hit, whether the client connection should end, and
+# the body bytes sent
+def cached_response_parts(entry: CacheEntry, client_conn_hdr, client_proxy_hdr,
+                          accept_encoding=None) -> Tuple[list, bool, int]:
+    suffix, end_conn = connection_suffix(client_conn_hdr, client_proxy_hdr)
+    age = b"age: %d\r\n" % int(entry.age())
+    head, body = entry.representation(accepts_gzip(accept_encoding))
+    size = entry.size if isinstance(entry, DiskEntry) else len(body)
+    return [head, age, suffix, memoryview(body)], end_conn, size
+
+# byte ranges (RFC 9110 section 14): a Range request is answered from a stored
+# response with 206 Partial Content, one range in the body or several as
+# multipart/byteranges, sliced from the body without copying or sent from a disk
+# entry's file as (offset, count) segments. Ranges count in the bytes the origin
+# sent, so a body the proxy compressed is decoded first. Requests for more than
+# MAX_RANGES ranges get the whole response
+MAX_RANGES = 16
+BYTERANGES_BOUNDARY = 'proxy-byteranges-' + os.urandom(8).hex()
+_RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+# (first, last) byte positions a Range value selects in a body of size bytes:
+# None if the value is invalid and is ignored, empty if no range is satisfiable
+def parse_range(value: str, size: int):
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        m = _RANGE_SPEC.match(spec)
+        if m is None or not (m.group(1) or m.group(2)):
+            return None
+        if m.group(1):
+            first = int(m.group(1))
+            last = int(m.group(2)) if m.group(2) else max(first, size - 1)
+            if last < first:
+                return None
+        else:
+            # suffix range: the final n bytes
+            n = int(m.group(2))
+            if n == 0:
+                continue
+            first, last = max(0, size - n), size - 1
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+    return ranges
+
+# true if the representation with these headers is the one an If-Range value
+# names: a strong entity tag, or the exact Last-Modified date
+def if_range_matches(value, headers) -> bool:
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('W/'):
+        return False
+    if value.startswith('"'):
+        return value == headers.get('etag')
+    date = parse_http_date(value)
+    return date is not None and date == parse_http_date(headers.get('last-modified'))
+
+# headers, body and size of the representation ranges are taken from, or None if
+# the entry cannot serve ranges to this client
+def range_representation(entry: CacheEntry, gzip_ok: bool):
+    if isinstance(entry, DiskEntry):
+        if entry.gzip and (entry.compressed or not gzip_ok):
+            return None
+        return entry.res.headers, b'', entry.size
+    if entry.compressed:
+        body = entry.decoded()
+        return vary_accept_encoding(entry.res.headers), body, len(body)
+    if entry.gzip and not gzip_ok:
+        body = entry.decoded()
+        return recoded_headers(entry.res.headers, None, len(body)), body, len(body)
+    return entry.res.headers, entry.body, len(entry.body)
+
+# the response to log, buffers to send, whether the client connection should end
+# and the body bytes sent for a Range request answered from entry, or None to
+# answer it with the whole response
+def range_response_parts(entry: CacheEntry, req: HTTPRequest, client_conn_hdr, client_proxy_hdr):
+    value = req.headers.get('range')
+    if value is None:
+        return None
+    represented = range_representation(entry, accepts_gzip(req.headers.get('accept-encoding')))
+    if represented is None:
+        return None
+    headers, body, size = represented
+    if not if_range_matches(req.headers.get('if-range'), headers):
+        return None
+    ranges = parse_range(value, size)
+    # the coding of a multipart body would apply to the part headers too
+    if ranges is None or (len(ranges) > 1 and 'content-encoding' in headers):
+        return None
+    suffix, end_conn = connection_suffix(client_conn_hdr, client_proxy_hdr)
+    age = b"age: %d\r\n" % int(entry.age())
+
+    if not ranges:
+        res = HTTPResponse(entry.res.version, 416, "Range Not Satisfiable")
+        res.headers['content-range'] = f"bytes */{size}"
+        res.headers['content-length'] = '0'
+        if 'via' in headers:
+            res.headers['via'] = headers['via']
+        return res, [stored_head(res, res.headers), age, suffix], end_conn, 0
+
+    disk = isinstance(entry, DiskEntry)
+    view = memoryview(body)
+    res = HTTPResponse(entry.res.version, 206, "Partial Content")
+    res.headers = headers.copy()
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        res.headers['content-range'] = f"bytes {first}-{last}/{size}"
+        body_parts = [(first, last - first + 1) if disk else view[first:last+1]]
+        sent = last - first + 1
+    else:
+        ctype = headers.get('content-type')
+        part_type = f"content-type: {ctype}\r\n" if ctype else ''
+        body_parts = []
+        sent = 0
+        for first, last in ranges:
+            # parts after the first start with the CRLF that ends the one before
+            part_head = (f"--{BYTERANGES_BOUNDARY}\r\n{part_type}"
+                         f"content-range: bytes {first}-{last}/{size}\r\n\r\n").encode('latin-1')
+            if body_parts:
+                part_head = b'\r\n' + part_head
+            body_parts += [part_head, (first, last - first + 1) if disk else view[first:last+1]]
+            sent += len(part_head) + last - first + 1
+        tail = f"\r\n--{BYTERANGES_BOUNDARY}--\r\n".encode('latin-1')
+        body_parts.append(tail)
+        sent += len(tail)
+        res.headers['content-type'] = f"multipart/byteranges; boundary={BYTERANGES_BOUNDARY}"
+    res.headers['content-length'] = str(sent)
+    return res, [stored_head(res, res.headers), age, suffix] + body_parts, end_conn, sent
+
+# the response to log, buffers to send, whether the client connection should end
+# and the body bytes sent for a request answered from the cache
+def hit_response_parts(entry: CacheEntry, req: HTTPRequest, client_conn_hdr, client_proxy_hdr):
+    ranged = range_response_parts(entry, req, client_conn_hdr, client_proxy_hdr)
+    if ranged is not None:
+        stats.count('range_hits')
+        return ranged
+    parts, end_conn, size = cached_response_parts(entry, client_conn_hdr, client_proxy_hdr,
+                                                  req.headers.get('accept-encoding'))
+    return entry.res, parts, end_conn, size
+
+# send several buffers with scatter-gather writes instead of joining them
+def send_parts(sock: socket.socket, parts: list):
+    views = [memoryview(part) for part in parts if len(part)]
+    if not hasattr(sock, 'sendmsg'):
+        for view in views:
+            sock.sendall(view)
+        return
+    while views:
+        sent = sock.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+# send a cache hit; the body of a disk entry goes from its file with sendfile,
+# whole or as the (offset, count) segments among the parts of a range response
+def send_cached(sock: socket.socket, entry: CacheEntry, parts: list):
+    if not isinstance(entry, DiskEntry):
+        send_parts(sock, parts)
+        return
+    if not any(isinstance(part, tuple) for part in parts):
+        parts = parts + [(0, None)]
+    with entry.open_body() as f:
+        start = 0
+        for i, part in enumerate(parts):
+            if isinstance(part, tuple):
+                send_parts(sock, parts[start:i])
+                sock.sendfile(f, *part)
+                start = i + 1
+        send_parts(sock, parts[start:])
+
+# most pipelined cache hits answered with one write
+PIPELINE_BATCH = 32
+
+# the next request a client pipelined, if its head is buffered already and it is a
+# GET answered from memory; returns (request, entry) and consumes the head, or None
+# leaving it for the main loop
+def pipelined_hit(reader: SocketReader):
+    if not reader.has_head():
+        return None
+    try:
+        req, body_start = parse_request_head(reader.buf, reader.start)
+    except ValueError:
+        return None
+    if req.method != 'GET' or req.headers.get('host') is None or request_framing(req) != 'none':
+        return None
+    if 'range' in req.headers:
+        return None
+    cached = cache.get(request_cache_key(req))
+    if cached is None or isinstance(cached, DiskEntry) or not cached.satisfies(req):
+        return None
+    reader.consume(body_start)
+    return req, cached
+
+# status line and headers of a response, including the blank line
+def response_head_bytes(res: HTTPResponse) -> bytes:
+    status = f"{res.version} {res.status_code} {res.reason}\r\n"
+    hdr_lines = ''.join(f"{k}: {v}\r\n" for k,v in res.headers.items())
+    return (status + hdr_lines + "\r\n").encode('latin-1')
+
+# set the response Connection and Proxy-Connection headers from the client's, returns True if the connection should end
+def apply_connection_headers(res: HTTPResponse, client_conn_hdr, client_proxy_hdr) -> bool:
+    res.headers.pop('proxy-connection', None)
+    res.headers['via'] = '1.1 z5592060'
+
+    end_conn = False
+    if client_conn_hdr and client_conn_hdr.lower() == 'close':
+        res.headers['connection'] = 'close'
+        end_conn = True
+    if client_proxy_hdr and client_proxy_hdr.lower() == 'close':
+        res.headers['proxy-connection'] = 'close'
+        end_conn = True
+    if client_conn_hdr and client_conn_hdr.lower() == 'keep-alive':
+        res.headers['connection'] = 'keep-alive'
+    if client_proxy_hdr and client_proxy_hdr.lower() == 'keep-alive':
+        res.headers['proxy-connection'] = 'keep-alive'
+    return end_conn
+
+# CONNECT tunnels: bytes moved per read, and whether to move them with splice(2)
+# through a pipe instead of copying them through user space (Linux only)
+TUNNEL_BUFFER = 256 * 1024
+TUNNEL_SPLICE = hasattr(os, 'splice')
+if TUNNEL_SPLICE:
+    import fcntl
+
+# one direction of a tunnel: moves bytes from src to dst until either would block,
+# and shuts dst down for writing once src has ended and everything is forwarded
+class _Flow:
+    def __init__(self, src: socket.socket, dst: socket.socket, pending: bytes = b''):
+        self.src = src
+        self.dst = dst
+        self.pending = memoryview(pending)  # copied bytes dst has not taken yet
+        self.piped = 0                      # spliced bytes waiting in the pipe
+        self.pipe = None
+        if TUNNEL_SPLICE:
+            self.pipe = os.pipe()
+            # let one splice move a whole TUNNEL_BUFFER instead of the default 64 KiB
+            try:
+                fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, TUNNEL_BUFFER)
+            except OSError:
+                pass
+        self.eof = False
+        self.done = False
+
+    def wants_read(self) -> bool:
+        return not self.eof and not self.pending and not self.piped
+
+    def wants_write(self) -> bool:
+        return bool(self.pending) or self.piped > 0
+
+    # raises OSError other than BlockingIOError if the tunnel is broken
+    def pump(self, buf: memoryview):
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK if TUNNEL_SPLICE else 0
+        try:
+            while not self.done:
+                if self.pending:
+                    self.pending = self.pending[self.dst.send(self.pending):]
+                elif self.piped:
+                    self.piped -= os.splice(self.pipe[0], self.dst.fileno(), self.piped, flags=flags)
+                elif self.eof:
+                    self.dst.shutdown(socket.SHUT_WR)
+                    self.done = True
+                elif self.pipe is not None:
+                    self.piped = os.splice(self.src.fileno(), self.pipe[1], TUNNEL_BUFFER, flags=flags)
+                    self.eof = self.piped == 0
+                else:
+                    n = self.src.recv_into(buf)
+                    self.eof = n == 0
+                    # send straight from the shared buffer, keep a copy only of what dst refused
+                    try:
+                        sent = self.dst.send(buf[:n]) if n else 0
+                    except BlockingIOError:
+                        sent = 0
+                    self.pending = memoryview(bytes(buf[sent:n]))
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+class _Tunnel:
+    def __init__(self, client: socket.socket, server: socket.socket, pending: bytes):
+        self.socks = (client, server)
+        self.flows = (_Flow(client, server, pending), _Flow(server, client))
+        self.events = {client: 0, server: 0}
+
+    # selector events each socket is waiting for, empty once the tunnel is finished
+    def interest(self) -> dict:
+        if all(flow.done for flow in self.flows):
+            return {}
+        events = {sock: 0 for sock in self.socks}
+        for flow in self.flows:
+            if flow.wants_read():
+                events[flow.src] |= selectors.EVENT_READ
+            if flow.wants_write():
+                events[flow.dst] |= selectors.EVENT_WRITE
+        return events
+
+    def close(self):
+        for flow in self.flows:
+            flow.close()
+        for sock in self.socks:
+            sock.close()
+
+# relays every CONNECT tunnel of the threaded engine on one thread, so a tunnel
+# costs two sockets (and two pipes) instead of a blocked thread; each side's EOF
+# is passed on as a half-close and the tunnel ends when both directions have
+class TunnelRelay:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.added = []
+        self.thread = None
+        self.active = 0
+
+    # take over a connected client and server socket, pending is client data already read
+    def add(self, client: socket.socket, server: socket.socket, pending: bytes = b''):
+        client.setblocking(False)
+        server.setblocking(False)
+        with self.lock:
+            if self.thread is None:
+                self.selector = selectors.DefaultSelector()
+                self.wake_r, self.wake_w = socket.socketpair()
+                self.wake_r.setblocking(False)
+                self.wake_w.setblocking(False)
+                self.selector.register(self.wake_r, selectors.EVENT_READ)
+                self.thread = threading.Thread(target=self._run, name='tunnel-relay', daemon=True)
+                self.thread.start()
+            self.added.append(_Tunnel(client, server, pending))
+            self.active += 1
+        try:
+            self.wake_w.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def _run(self):
+        buf = memoryview(bytearray(TUNNEL_BUFFER))
+        while True:
+            ready = set()
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    try:
+                        self.wake_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    with self.lock:
+                        ready.update(self.added)
+                        self.added = []
+                else:
+                    ready.add(key.data)
+            for tunnel in ready:
+                try:
+                    for flow in tunnel.flows:
+                        flow.pump(buf)
+                    events = tunnel.interest()
+                except OSError:
+                    events = {}
+                self._update(tunnel, events)
+
+    def _update(self, tunnel: _Tunnel, events: dict):
+        for sock in tunnel.socks:
+            old, new = tunnel.events[sock], events.get(sock, 0)
+            if old and not new:
+                self.selector.unregister(sock)
+            elif new and not old:
+                self.selector.register(sock, new, tunnel)
+            elif new != old:
+                self.selector.modify(sock, new, tunnel)
+            tunnel.events[sock] = new
+        if not events:
+            tunnel.close()
+            with self.lock:
+                self.active -= 1
+
+tunnel_relay = TunnelRelay()
+
+# per client address connection limits, and counts of connections turned away
+class Admission:
+    def __init__(self, max_per_ip: int):
+        self.max_per_ip = max_per_ip
+        self.per_ip: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.active = 0
+        self.rejected_busy = 0      # no worker or queue slot free
+        self.rejected_ip = 0        # client address over its limit
+
+    # count a new connection, False if its address already has too many
+    def admit(self, ip: str) -> bool:
+        with self.lock:
+            count = self.per_ip.get(ip, 0)
+            if self.max_per_ip and count >= self.max_per_ip:
+                self.rejected_ip += 1
+                return False
+            self.per_ip[ip] = count + 1
+            self.active += 1
+            return True
+
+    def release(self, ip: str):
+        with self.lock:
+            self.active -= 1
+            count = self.per_ip.pop(ip) - 1
+            if count:
+                self.per_ip[ip] = count
+
+    def busy(self):
+        with self.lock:
+            self.rejected_busy += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'active': self.active, 'clients': len(self.per_ip),
+                    'rejected_busy': self.rejected_busy, 'rejected_ip': self.rejected_ip}
+
+admission = Admission(MAX_PER_IP)
+
+# sent without reading the request when a connection cannot be served
+BUSY_RESPONSE = error_response_bytes('HTTP/1.1', 503, "Service Unavailable", "proxy busy")
+
+def reject_busy(client_conn: socket.socket):
+    try:
+        client_conn.setblocking(False)
+        client_conn.send(BUSY_RESPONSE)
+    except OSError:
+        pass
+    client_conn.close()
+
+# fixed set of threads serving accepted connections from a bounded queue, so a
+# connection flood queues and then gets 503 instead of starting a thread each
+class WorkerPool:
+    def __init__(self, workers: int, queue_size: int):
+        self.queue = queue.Queue(queue_size)
+        self.busy = 0
+        self.lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"worker-{i}", daemon=True).start()
+
+    # queue a connection for a worker, False if the queue is full
+    def submit(self, client_conn: socket.socket, ip: str) -> bool:
+        try:
+            self.queue.put_nowait((client_conn, ip))
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            client_conn, ip = self.queue.get()
+            with self.lock:
+                self.busy += 1
+            # a worker must outlive any connection it serves
+            try:
+                handle_client(client_conn)
+            except Exception as e:
+                print(f"Worker {threading.current_thread().name} error: {e}")
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                admission.release(ip)
+
+worker_pool = None
+
+# ---------------------------------------------------------------------------
+# statistics, served as JSON to GET STATS_PATH sent to the proxy itself
+# ---------------------------------------------------------------------------
+
+STATS_PATH = '/__proxy/stats'
+
+# latency histogram buckets: bucket b counts times of 2^(b-1) up to 2^b microseconds
+HIST_BUCKETS = 32
+
+# what each access log cache flag counts as, and the counter for its body bytes
+CACHE_FLAG_NAMES = {'H': 'hits', 'C': 'coalesced', 'M': 'misses', 'R': 'revalidated', '-': 'uncached'}
+_FLAG_COUNTERS = {flag: (name, 'bytes_' + name) for flag, name in CACHE_FLAG_NAMES.items()}
+_STATUS_COUNTERS = ['status_%dxx' % n for n in range(10)]
+
+# counters and latency histograms of one thread; a histogram is HIST_BUCKETS
+# counts followed by the sum of the times
+class _ThreadStats:
+    def __init__(self):
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, list] = {}
+
+# each thread records into its own _ThreadStats without taking a lock, and a
+# scrape adds them all up, so recording costs a few dict updates and nothing
+# else happens until someone asks for the report
+class Stats:
+    def __init__(self):
+        self.local = threading.local()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def _mine(self) -> _ThreadStats:
+        try:
+            return self.local.stats
+        except AttributeError:
+            mine = self.local.stats = _ThreadStats()
+            with self.lock:
+                self.threads.append(mine)
+            return mine
+
+    def count(self, name: str, n: int = 1):
+        counters = self._mine().counters
+        counters[name] = counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float):
+        histograms = self._mine().histograms
+        hist = histograms.get(name)
+        if hist is None:
+            hist = histograms[name] = [0] * HIST_BUCKETS + [0.0]
+        b = int(seconds * 1e6).bit_length()
+        hist[b if b < HIST_BUCKETS else HIST_BUCKETS - 1] += 1
+        hist[HIST_BUCKETS] += seconds
+
+    # one logged request: counted by cache flag and status class, with its body bytes
+    def request(self, cache_flag: str, status: int, body_bytes: int):
+        counters = self._mine().counters
+        name, bytes_name = _FLAG_COUNTERS.get(cache_flag) or (cache_flag, 'bytes_' + cache_flag)
+        status_name = _STATUS_COUNTERS[status // 100 % 10]
+        counters[name] = counters.get(name, 0) + 1
+        counters[status_name] = counters.get(status_name, 0) + 1
+        counters[bytes_name] = counters.get(bytes_name, 0) + body_bytes
+
+    def snapshot(self) -> Tuple[dict, dict]:
+        counters: Dict[str, int] = {}
+        histograms: Dict[str, list] = {}
+        with self.lock:
+            threads = list(self.threads)
+        for mine in threads:
+            # list() copies in one step, other threads may be adding names
+            for name, n in list(mine.counters.items()):
+                counters[name] = counters.get(name, 0) + n
+            for name, hist in list(mine.histograms.items()):
+                total = histograms.setdefault(name, [0] * HIST_BUCKETS + [0.0])
+                for b, n in enumerate(list(hist)):
+                    total[b] += n
+        counters['requests'] = sum(counters.get(name, 0) for name in CACHE_FLAG_NAMES.values())
+        latency = {}
+        for name, hist in sorted(histograms.items()):
+            count = sum(hist[:HIST_BUCKETS])
+            summary = {'count': count, 'mean': round(hist[HIST_BUCKETS] / count * 1000, 3) if count else 0.0}
+            for label, q in (('p50', .5), ('p90', .9), ('p99', .99), ('p999', .999)):
+                # upper edge of the bucket the quantile falls in
+                seen = 0
+                for b in range(HIST_BUCKETS):
+                    seen += hist[b]
+                    if seen >= q * count:
+                        summary[label] = (1 << b) / 1000
+                        break
+            latency[name] = summary
+        return dict(sorted(counters.items())), latency
+
+stats = Stats()
+
+# whether req asks the proxy itself for its statistics
+def is_stats_request(req: HTTPRequest) -> bool:
+    if not req.url.endswith(STATS_PATH):
+        return False
+    if req.url == STATS_PATH:
+        return True
+    host_port, path = split_url(req.url)
+    host, _, port = host_port.partition(':')
+    return path == STATS_PATH and is_proxy_address(host, int(port) if port.isdigit() else 80)
+
+def stats_report() -> dict:
+    counters, latency = stats.snapshot()
+    local = cache.local if isinstance(cache, CacheClient) else cache
+    report = {
+        'pid': os.getpid(),
+        'engine': ENGINE,
+        'uptime': round(time.time() - stats.started, 3),
+        'counters': counters,
+        'latency_ms': latency,
+        'connections': admission.stats(),
+        'threads': threading.active_count(),
+        'tunnels': tunnel_relay.active + len(_tunnel_tasks),
+        'cache': {
+            'policy': local.policy,
+            'entries': sum(len(shard.policy.entries) for shard in local.shards),
+            'bytes': local.size,
+            'max_bytes': local.max_bytes,
+            'evictions': local.evictions,
+            'evicted_bytes': local.evicted_bytes,
+        },
+        'upstream_idle': upstream_pool.idle_count + async_upstream_pool.idle_count,
+        'dns_cached': len(resolver.entries),
+        'access_log': {'queued': access_log.queue.qsize(), 'dropped': access_log.dropped},
+    }
+    if worker_pool is not None:
+        report['connections'].update(queued=worker_pool.depth(), busy=worker_pool.busy)
+    if isinstance(disk_cache, DiskCache):
+        report['disk_cache'] = {'entries': len(disk_cache.entries), 'bytes': disk_cache.size,
+                                'max_bytes': disk_cache.max_bytes}
+    return report
+
+# the report as a response to req, returns (response, bytes to send, whether to end the connection)
+def stats_response(req: HTTPRequest, client_conn_hdr, client_proxy_hdr) -> Tuple[HTTPResponse, bytes, bool]:
+    res = HTTPResponse(req.version, 200, 'OK')
+    res.body = json.dumps(stats_report(), indent=2).encode('ascii') + b'\n'
+    res.headers['content-type'] = 'application/json'
+    res.headers['cache-control'] = 'no-store'
+    res.headers['content-length'] = str(len(res.body))
+    suffix, end_conn = connection_suffix(client_conn_hdr, client_proxy_hdr)
+    # the head without its blank line, the suffix adds the connection headers and one
+    return res, response_head_bytes(res)[:-2] + suffix + res.body, end_conn
+
+# handle client connection
+def handle_client(client_conn: socket.socket):
+    # the miss this thread is fetching for other requesters of the same URL
+    flight = None
+    try:
+        client_addr = peer_address(client_conn)
+        client_conn.settimeout(TIMEOUT)
+        # each response goes out whole, so Nagle only delays the ones that follow it
+        # on a pipelined or keep-alive connection (asyncio sets this for its transports)
+        client_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = SocketReader(client_conn)
+        # origin responses are read through one more buffer, made on the first miss
+        upstream = None
+        # loop for persistence
+        while True:
+            thread_name = threading.current_thread().name
+
+            # read request from client
+            try:
+                head = reader.read_head()
+            except socket.timeout:
+                if VERBOSE:
+                    print("Timeout while receiving request")
+                # return to close the connection
+                return
+            except HeadTooLarge:
+                temp = HTTPRequest("GET", "", "HTTP/1.1")
+                send_log_error_response(client_conn, temp, 431, "Request Header Fields Too Large", "head too large")
+                return
+            except ValueError:
+                temp = HTTPRequest("GET", "", "HTTP/1.1")
+                send_log_error_response(client_conn, temp, 400, "Bad Request", "malformed request")
+                return
+            if head < 0: return
+            started = time.perf_counter()
+            try:
+                req, body_start = parse_request_head(reader.buf, head)
+            except HeadTooLarge:
+                temp = HTTPRequest("GET", "", "HTTP/1.1")
+                send_log_error_response(client_conn, temp, 431, "Request Header Fields Too Large", "head too large")
+                return
+            except ValueError as e:
+                temp = HTTPRequest("GET", "", "HTTP/1.1")
+                send_log_error_response(client_conn, temp, 400, "Bad Request", "malformed request")
+                return
+            stats.observe('parse', time.perf_counter() - started)
+            reader.consume(body_start)
+            # if request contains a body, read it; the pieces are views into the
+            # reader's buffer, so each is copied out before the next read
+            try:
+                framing = request_framing(req)
+                decoder = make_decoder(framing, req.headers)
+                if not decoder.done:
+                    body = bytearray()
+                    for piece in iter_body(reader, decoder):
+                        body += piece
+                    req.body = bytes(body)
+            except ValueError:
+                send_log_error_response(client_conn, req, 400, "Bad Request", "malformed request")
+                return
+            if framing == 'chunked':
+                req.headers.pop('transfer-encoding', None)
+                req.headers['content-length'] = str(len(req.body))
+
+            client_conn_hdr = req.headers.get('connection')
+            client_proxy_hdr = req.headers.get('proxy-connection')
+
+            if req.method == 'GET' and is_stats_request(req):
+                res, data, end_conn = stats_response(req, client_conn_hdr, client_proxy_hdr)
+                client_conn.sendall(data)
+                log_request(req, res, client_addr, '-')
+                if end_conn:
+                    break
+                continue
+
+            if req.method != 'CONNECT' and req.headers.get('host') is None:
+                send_log_error_response(client_conn, req, 400, "Bad Request", "no host")
+                return
+            
+            cache_flag = '-'
+            stale = None
+            if req.method == 'GET':
+                cache_key, cached = cache_lookup(req)
+                if cached is not None and not cached.satisfies(req):
+                    # stale, or the client asked for it to be checked with the origin
+                    stale, cached = cached, None
+                # range misses go to the origin straight away, a 206 cannot finish a flight
+                if not cached and 'range' not in req.headers:
+                    # wait for a fetch of the same URL already in progress
+                    pending_flight, leader = coalescer.join(cache_key)
+                    if leader:
+                        flight = pending_flight
+                    else:
+                        cached = coalesced_entry(req, cache_key, pending_flight.wait(TIMEOUT))
+                        cache_flag = 'C'
+                if cached:
+                    if cache_flag != 'C':
+                        cache_flag = 'H'
+                    res, parts, end_conn, size = hit_response_parts(cached, req, client_conn_hdr, client_proxy_hdr)
+                    hits = [(req, res, cache_flag, size)]
+                    # hits the client pipelined behind this one go out in the same write
+                    while not end_conn and len(hits) < PIPELINE_BATCH and not isinstance(cached, DiskEntry):
+                        pipelined = pipelined_hit(reader)
+                        if pipelined is None:
+                            break
+                        req, cached = pipelined
+                        more, end_conn, size = cached_response_parts(cached, req.headers.get('connection'),
+                                                                     req.headers.get('proxy-connection'),
+                                                                     req.headers.get('accept-encoding'))
+                        parts += more
+                        hits.append((req, cached.res, 'H', size))
+                    send_cached(client_conn, cached, parts)
+                    stats.observe('hit', time.perf_counter() - started)
+                    if len(hits) > 1:
+                        stats.count('pipelined_hits', len(hits) - 1)
+                    for req, res, cache_flag, size in hits:
+                        log_request(req, res, client_addr, cache_flag, size)
+                    if end_conn:
+                        break
+                    continue
+                else:
+                    cache_flag = 'M'
+
+            if VERBOSE:
                 print("----------------- RECEIVED REQUEST FROM CLIENT -----------------")
-                print(f"[{thread_name}] Client: {client_conn.getpeername()}")
+                print(f"[{thread_name}] Client: {client_addr}")
                 print(f"Received request: {req}")
                 print(f"Headers:")
-                print(f"{json.dumps(req.headers, indent=4)}")
+                print(f"{json.dumps(list(req.headers.items()), indent=4)}")
                 print(f"Body: {req.body[:100]}... (truncated if long)")
                 print("\n")
 
@@ -320,245 +2881,678 @@ def handle_client(client_conn: socket.socket):
                 if port != 443:
                     send_log_error_response(client_conn, req, 400, "Bad Request", "invalid port")
                     return
-                if host in (HOST, '127.0.0.1', 'localhost') and port == PORT:
+                if is_proxy_address(host, port):
                     send_log_error_response(client_conn, req, 421, "Misdirected Request", "proxy address")
                     return
 
                 # establish TCP tunnel
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_sock:
-                    server_sock.settimeout(TIMEOUT)
-                    try:
-                        server_sock.connect((host, port))
-                    except socket.gaierror:
-                        send_log_error_response(client_conn, req, 502, "Bad Gateway", "could not resolve")
-                        return
-                    except ConnectionRefusedError:
-                        send_log_error_response(client_conn, req, 502, "Bad Gateway", "connection refused")
-                        return
+                try:
+                    server_sock = connect_upstream(host, port)
+                except socket.gaierror:
+                    send_log_error_response(client_conn, req, 502, "Bad Gateway", "could not resolve")
+                    return
+                except ConnectionRefusedError:
+                    send_log_error_response(client_conn, req, 502, "Bad Gateway", "connection refused")
+                    return
+                with server_sock:
                     resp_line = f"{req.version} 200 Connection Established\r\n"
                     resp_line += f"Via: 1.1 z5592060\r\nConnection: close\r\n\r\n"
                     client_conn.sendall(resp_line.encode('ascii'))
 
                     dummy_response = HTTPResponse(req.version, 200, "Connection Established")
                     dummy_response.body = b''
-                    entry = generate_clf_entry(
-                        req,
-                        dummy_response,
-                        client_conn.getpeername(),
-                        cache_flag='-'
-                    )
-                    print(entry)
-                    with lock:
-                        with open('log.log', 'a') as log_file:
-                            log_file.write(entry + '\n')
-
-                    sockets = [client_conn, server_sock]
-                    # loop to constantly send and receive data
-                    while True:
-                        rlist, _, _ = select.select(sockets, [], [])
-                        if client_conn in rlist:
-                            data = client_conn.recv(4096)
-                            if not data: break
-                            server_sock.sendall(data)
-                        if server_sock in rlist:
-                            data = server_sock.recv(4096)
-                            if not data: break
-                            client_conn.sendall(data)
+                    log_request(req, dummy_response, client_addr, cache_flag='-')
+
+                    # hand both sockets to the relay thread, detached so closing here leaves them open
+                    tunnel_relay.add(socket.socket(fileno=client_conn.detach()),
+                                     socket.socket(fileno=server_sock.detach()), reader.drain())
                 return
 
             # other methods get, post, put
-            # format headers
-            req.headers.pop('proxy-connection', None)
-            req.headers.pop('connection', None)
-            req.headers['connection'] = 'close'
-            via = '1.1 z5592060'
-            if 'via' in req.headers:
-                req.headers['via'] += ', ' + via
-            else:
-                req.headers['via'] = via
-
-            # extract the origin form
-            host_port, path = split_url(req.url)
-            if ':' in host_port:
-                host,port_str = host_port.split(':',1)
-                port = int(port_str)
-            else:
-                host = host_port; port = 80
-            req.headers['host'] = host_port
+            revalidating = add_validators(req, stale)
+            try:
+                host, port, forward_data = prepare_forward(req)
+            except ValueError:
+                send_log_error_response(client_conn, req, 400, "Bad Request", "invalid port")
+                return
 
-            if host in (HOST, '127.0.0.1', 'localhost') and port == PORT:
+            if is_proxy_address(host, port):
                 send_log_error_response(client_conn, req, 421, "Misdirected Request", "proxy address")
                 return
 
-            # rebuild the request line and forward it to the server
-            request_line = f"{req.method} {path} {req.version}\r\n"
-            hdrs = ''.join(f"{k}: {v}\r\n" for k,v in req.headers.items())
-            forward_data = (request_line + hdrs + '\r\n').encode('ascii') + req.body
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_sock:
-                server_sock.settimeout(TIMEOUT)
-                try: 
-                    server_sock.connect((host, port))
-                except socket.timeout:
-                    send_log_error_response(client_conn, req, 504, "Gateway Timeout", "timed out")
-                    return
-                except ConnectionRefusedError:
-                    send_log_error_response(client_conn, req, 502, "Bad Gateway", "connection refused")
+            if VERBOSE:
+                print("----------------- FORWARDING REQUEST TO ORIGIN -----------------")
+                print(f"[{thread_name}] Origin: {host}:{port}")
+                print(f"Forwarding request: {req}")
+                print("Headers:")
+                print(json.dumps(list(req.headers.items()), indent=4))
+                print(f"Body: {req.body[:100]}... (truncated if long)")
+                print("\n")
+
+            if upstream is None:
+                upstream = SocketReader()
+            try:
+                # send to the origin and receive the response head
+                sent = time.perf_counter()
+                server_sock, head = forward_upstream(upstream, host, port, req.method, forward_data)
+                stats.observe('upstream_ttfb', time.perf_counter() - sent)
+            except socket.timeout:
+                send_log_error_response(client_conn, req, 504, "Gateway Timeout", "timed out")
+                return
+            except ConnectionRefusedError:
+                send_log_error_response(client_conn, req, 502, "Bad Gateway", "connection refused")
+                return
+            except socket.gaierror:
+                send_log_error_response(client_conn, req, 502, "Bad Gateway", "could not resolve")
+                return
+            except HeadTooLarge:
+                send_log_error_response(client_conn, req, 502, "Bad Gateway", "response head too large")
+                return
+            except ValueError:
+                send_log_error_response(client_conn, req, 502, "Bad Gateway", "closed unexpectedly")
+                return
+
+            # the connection goes back to the pool only if the body was fully read with known framing
+            reusable = False
+            origin_reusable = False
+            refreshed = None
+            try:
+                try:
+                    res, body_start = parse_response_head(upstream.buf, head)
+                except ValueError:
+                    send_log_error_response(client_conn, req, 502, "Bad Gateway", "closed unexpectedly")
                     return
-                except socket.gaierror:
-                    send_log_error_response(client_conn, req, 502, "Bad Gateway", "could not resolve")
+                upstream.consume(body_start)
+                # decided from the origin's own head, before the client's connection headers replace it
+                origin_reusable = upstream_reusable(res)
+                framing = response_framing(req, res)
+                try:
+                    decoder = make_decoder(framing, res.headers)
+                except ValueError:
+                    send_log_error_response(client_conn, req, 502, "Bad Gateway", "invalid content-length")
                     return
-                
+                if res.status_code == 206 and req.method == 'GET':
+                    fill_after_range(req, res)
+
                 if VERBOSE:
-                    print("----------------- FORWARDING REQUEST TO ORIGIN -----------------")
+                    print("----------------- RECEIVED RESPONSE FROM ORIGIN -----------------")
                     print(f"[{thread_name}] Origin: {host}:{port}")
-                    print(f"Forwarding request: {req}")
+                    print(f"Response: {res}")
                     print("Headers:")
-                    print(json.dumps(req.headers, indent=4))
-                    print(f"Body: {req.body[:100]}... (truncated if long)")
+                    print(json.dumps(list(res.headers.items()), indent=4))
                     print("\n")
 
-                server_sock.sendall(forward_data)
-
-                try:
-                    # receive response from server
-                    resp_hdr_buf = recv_until(server_sock)
-                except socket.timeout:
-                    send_log_error_response(client_conn, req, 504, "Gateway Timeout", "timed out")
-                    return
-                
-                head_s, rest = _split_head_body(resp_hdr_buf)
-                res = parse_http_response(resp_hdr_buf)
-                body_buf = bytearray(rest)
+                if revalidating is not None and res.status_code == 304:
+                    # the stored copy is still valid, answer from it below
+                    refreshed = refresh_entry(cache_key, revalidating, res)
+                    reusable = not upstream.buffered()
+                else:
+                    # handle Connection and Proxy-Connection headers for persistence
+                    end_conn = apply_connection_headers(res, client_conn_hdr, client_proxy_hdr)
+                    tee = BodyTee(req, res, framing)
+                    if tee.close_delimited:
+                        end_conn = True
+                    if flight is not None and tee.buf is None:
+                        # not storable, waiting requests go to the origin without waiting for the body
+                        coalescer.finish(cache_key, flight, None)
+                        flight = None
 
-                try:
-                    # if head method or 1xx,204,304 status codes, no body
-                    if req.method == 'HEAD' or 100 <= res.status_code < 200 or res.status_code in (204,304):
-                        full_body = b''
-                    # if content-length header, read exact bytes
-                    elif 'content-length' in res.headers:
-                        total = int(res.headers['content-length'])
-                        needed = total - len(rest)
-                        if needed > 0:
-                            try:
-                                body_buf.extend(recv_exact(server_sock, needed))
-                            except socket.timeout:
-                                send_log_error_response(client_conn, req, 504, "Gateway Timeout", "timed out")
-                                return
-                        
-                        if len(body_buf) < total:
-                            send_log_error_response(client_conn, req, 502, "Bad Gateway", "closed unexpectedly")
-                            return
-
-                        full_body = bytes(body_buf)
-                    # if Transfer-Encoding is chunked, read chunks until size 0
-                    elif res.headers.get('transfer-encoding', '').lower() == 'chunked':
-                        buf = bytearray()
-                        while True:
-                            line = b''
-                            while not line.endswith(b'\r\n'):
-                                byte = server_sock.recv(1)
-                                if not byte:
-                                    break
-                                line += byte
-                            if not line:
-                                break
-                            size_str = line.strip().split(b';',1)[0]
-                            try:
-                                size = int(size_str, 16)
-                            except ValueError:
-                                send_log_error_response(client_conn, req, 502, "Bad Gateway", "closed unexpectedly")
-                                return
-                            if size == 0:
-                                _ = recv_until(server_sock)
-                                break
-                            data = recv_exact(server_sock, size + 2)
-                            if len(data) < size + 2:
-                                send_log_error_response(client_conn, req, 502, "Bad Gateway", "closed unexpectedly")
-                                return
-                            buf.extend(data[:-2])
-
-                        full_body = bytes(buf)
-                        res.headers.pop('transfer-encoding', None)
-                        res.headers['content-length'] = str(len(full_body))
-                    else:
-                        while True:
-                            chunk = server_sock.recv(4096)
-                            if not chunk: break
-                            body_buf.extend(chunk)
-                        full_body = bytes(body_buf)
-                except socket.timeout:
-                    send_log_error_response(client_conn, req, 504, "Gateway Timeout", "timed out")
-                    return
-                except Exception as e:
-                    print(f"Error reading response body: {e}")
-                    traceback.print_exc()
-                    full_body = b''
+                    # send the head now and stream the body as it arrives
+                    client_conn.sendall(response_head_bytes(res))
+                    try:
+                        server_sock.settimeout(TIMEOUT)
+                        relay_start = time.perf_counter()
+                        for piece in iter_body(upstream, decoder):
+                            client_conn.sendall(tee.frame(piece))
+                            if flight is not None and tee.buf is None:
+                                # the body outgrew the cache, waiting requests fetch it themselves
+                                coalescer.finish(cache_key, flight, None)
+                                flight = None
+                        client_conn.sendall(tee.end())
+                        stats.observe('transfer', time.perf_counter() - relay_start)
+                        reusable = framing != 'close' and not decoder.unused
+                    except (socket.timeout, OSError, ValueError) as e:
+                        # too late for an error response, drop the client connection instead
+                        if VERBOSE:
+                            print(f"Error relaying response body: {e}")
+                        tee.discard()
+                        log_request(req, res, client_addr, cache_flag, tee.length)
+                        return
+            finally:
+                if reusable and origin_reusable:
+                    upstream_pool.release(host, port, server_sock)
+                else:
+                    server_sock.close()
 
-            if VERBOSE:
-                print("----------------- RECEIVED RESPONSE FROM ORIGIN -----------------")
-                print(f"[{thread_name}] Origin: {host}:{port}")
-                print(f"Response: {res}")
-                print("Headers:")
-                print(json.dumps(res.headers, indent=4))
-                print(f"Body: {full_body[:100]}... (truncated if long)")
-                print("\n")
+            if refreshed is not None:
+                cache_flag = 'R'
+                if flight is not None:
+                    coalescer.finish(cache_key, flight, refreshed)
+                    flight = None
+                res, parts, end_conn, size = hit_response_parts(refreshed, req, client_conn_hdr, client_proxy_hdr)
+                send_cached(client_conn, refreshed, parts)
+                log_request(req, res, client_addr, cache_flag, size)
+                if end_conn:
+                    break
+                continue
 
-            # send response back to client
-            res.body = full_body
-            res.headers.pop('proxy-connection', None)
-            res.headers['via'] = '1.1 z5592060'
-
-            # handle Connection and Proxy-Connection headers for persistence
-            end_conn = False
-            if client_conn_hdr and client_conn_hdr.lower() == 'close':
-                res.headers['connection'] = 'close'
-                end_conn = True
-            if client_proxy_hdr and client_proxy_hdr.lower() == 'close':
-                res.headers['proxy-connection'] = 'close'
-                end_conn = True
-            if client_conn_hdr and client_conn_hdr.lower() == 'keep-alive':
-                res.headers['connection'] = 'keep-alive'
-            if client_proxy_hdr and client_proxy_hdr.lower() == 'keep-alive':
-                res.headers['proxy-connection'] = 'keep-alive'
-
-            status = f"{res.version} {res.status_code} {res.reason}\r\n"
-            hdr_lines = ''.join(f"{k}: {v}\r\n" for k,v in res.headers.items())
-            client_conn.sendall(status.encode('ascii') + hdr_lines.encode('ascii') + b"\r\n" + res.body)
-            
             if req.method == 'GET':
-                cache_put(cache_key, res)
+                cached = tee.store(req)
+                if flight is not None:
+                    coalescer.finish(cache_key, flight, cached)
+                    flight = None
 
             if VERBOSE:
                 print("----------------- FORWARDING RESPONSE TO CLIENT -----------------")
-                print(f"[{thread_name}] Client: {client_conn.getpeername()}")
+                print(f"[{thread_name}] Client: {client_addr}")
                 print(f"Response: {res}")
                 print("Headers:")
-                print(json.dumps(res.headers, indent=4))
-                print(f"Body: {res.body[:100]}... (truncated if long)")
+                print(json.dumps(list(res.headers.items()), indent=4))
+                print(f"Body: {tee.length} bytes streamed")
                 print("\n")
 
             # log the request and response
-            log_entry = generate_clf_entry(req, res, client_conn.getpeername(), cache_flag)
-            print(log_entry)
-            with lock:
-                with open('log.log', 'a') as log_file:
-                    log_file.write(log_entry + '\n')
+            stats.observe('miss', time.perf_counter() - started)
+            log_request(req, res, client_addr, cache_flag, tee.length)
 
             if end_conn:
                 break
+    except ConnectionError:
+        # the client went away mid-response, nothing to answer
+        pass
     except Exception as e:
         print(f"Error handling client: {e}")
         traceback.print_exc()
-        client_conn.sendall(b"HTTP/1.1 500 Internal Server Error\r\n\r\n")
+        try:
+            client_conn.sendall(b"HTTP/1.1 500 Internal Server Error\r\n\r\n")
+        except OSError:
+            pass
     finally:
+        # let waiters fetch for themselves if this thread gave up on the URL
+        if flight is not None:
+            coalescer.finish(cache_key, flight, None)
         client_conn.close()
 
 
-# main
-def main():
+# ---------------------------------------------------------------------------
+# event loop engine (--engine=async)
+# same request handling as handle_client, but every client, origin and tunnel
+# socket is non-blocking and multiplexed on one asyncio loop
+# ---------------------------------------------------------------------------
+
+# receive buffer limit per stream, bounds memory per idle connection
+ASYNC_STREAM_LIMIT = 64 * 1024
+
+async def send_log_error_response_async(writer, req, code, reason, phrase, cache_flag='-'):
+    writer.write(error_response_bytes(req.version, code, reason, phrase))
+    await writer.drain()
+    _log_error(req, code, reason, phrase, writer.get_extra_info('peername'), cache_flag)
+
+# async version of send_cached
+async def send_cached_async(writer: asyncio.StreamWriter, entry: CacheEntry, parts: list):
+    if not isinstance(entry, DiskEntry):
+        # one write for the whole response, write() per part is a send() each
+        writer.writelines(parts)
+        await writer.drain()
+        return
+    if not any(isinstance(part, tuple) for part in parts):
+        parts = parts + [(0, None)]
+    loop = asyncio.get_running_loop()
+    with entry.open_body() as f:
+        start = 0
+        for i, part in enumerate(parts):
+            if isinstance(part, tuple):
+                writer.writelines(parts[start:i])
+                await writer.drain()
+                await loop.sendfile(writer.transport, f, *part)
+                start = i + 1
+        writer.writelines(parts[start:])
+        await writer.drain()
+
+# under --workers a cache call can wait on the cache process's socket, so the
+# event loop makes it from the executor; in one process it runs in place
+async def cache_call_async(fn, *args):
+    if isinstance(cache, CacheClient):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    return fn(*args)
+
+# async version of cache_lookup, answered in place when the worker's local cache has the entry
+async def cache_lookup_async(req: HTTPRequest):
+    if isinstance(cache, CacheClient):
+        key = request_cache_key(req)
+        entry = cache.local.get(key)
+        if entry is not None:
+            return key, entry
+    return await cache_call_async(cache_lookup, req)
+
+def _stream_idle_ok(conn) -> bool:
+    reader, writer = conn
+    return not (reader.at_eof() or writer.is_closing())
+
+async_upstream_pool = UpstreamPool(POOL_MAX_IDLE, POOL_MAX_PER_HOST, POOL_IDLE_TIMEOUT,
+                                   is_ok=_stream_idle_ok, close=lambda conn: conn[1].close())
+
+# one connection attempt of _connect_first_async, closes its socket if cancelled
+async def _connect_attempt(family: int, sockaddr) -> socket.socket:
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.get_running_loop().sock_connect(sock, sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+# an attempt that was still running when another one won
+def _discard_attempt(task: asyncio.Future):
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+# async version of _connect_each and _connect_race
+async def _connect_first_async(addrs: tuple) -> socket.socket:
+    addrs = list(addrs)
+    race = len(addrs) > 1 and HAPPY_EYEBALLS_DELAY > 0
+    pending = set()
+    error = None
+    try:
+        while True:
+            if addrs and (race or not pending):
+                pending.add(asyncio.ensure_future(_connect_attempt(*addrs.pop(0))))
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, timeout=HAPPY_EYEBALLS_DELAY if race and addrs else None,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result().close()
+            if winner is not None:
+                return winner
+    finally:
+        for task in pending:
+            task.add_done_callback(_discard_attempt)
+            task.cancel()
+
+async def connect_upstream_async(host: str, port: int):
+    addrs = await resolver.resolve_async(host, port)
+    start = time.perf_counter()
+    sock = await asyncio.wait_for(_connect_first_async(addrs), TIMEOUT)
+    conn = await asyncio.open_connection(sock=sock, limit=ASYNC_STREAM_LIMIT)
+    stats.observe('upstream_connect', time.perf_counter() - start)
+    return conn
+
+# async version of forward_upstream, returns ((reader, writer), head bytes)
+async def forward_upstream_async(host: str, port: int, method: str, forward_data: bytes):
+    if method in IDEMPOTENT_METHODS:
+        conn = async_upstream_pool.acquire(host, port)
+        if conn is not None:
+            s_reader, s_writer = conn
+            try:
+                s_writer.write(forward_data)
+                await s_writer.drain()
+                head = await asyncio.wait_for(s_reader.readuntil(b"\r\n\r\n"), TIMEOUT)
+                stats.count('upstream_reused')
+                return conn, head
+            except asyncio.TimeoutError:
+                s_writer.close()
+                raise
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                # reset, or a broken or oversized head: try again on a fresh connection
+                s_writer.close()
+
+    conn = await connect_upstream_async(host, port)
+    s_reader, s_writer = conn
+    try:
+        s_writer.write(forward_data)
+        await s_writer.drain()
+        return conn, await asyncio.wait_for(s_reader.readuntil(b"\r\n\r\n"), TIMEOUT)
+    except BaseException:
+        s_writer.close()
+        raise
+
+# async version of iter_body, reads only what the decoder asks for so a
+# following pipelined message stays in the stream
+async def aiter_body(reader: asyncio.StreamReader, decoder: BodyDecoder):
+    while not decoder.done:
+        want = decoder.wanted()
+        if want == 0:
+            data = await asyncio.wait_for(reader.readline(), TIMEOUT)
+        else:
+            data = await asyncio.wait_for(reader.read(RELAY_CHUNK if want is None else min(want, RELAY_CHUNK)), TIMEOUT)
+        if not data:
+            decoder.eof()
+            return
+        for piece in decoder.feed(data):
+            yield piece
+
+# copy bytes one way through a CONNECT tunnel, then pass the EOF on as a half-close
+async def _pipe(src: asyncio.StreamReader, dst: asyncio.StreamWriter):
+    while True:
+        data = await src.read(TUNNEL_BUFFER)
+        if not data: break
+        dst.write(data)
+        await dst.drain()
+    if dst.can_write_eof():
+        dst.write_eof()
+
+# tasks relaying a tunnel; once a side has half-closed its transport is no longer
+# watched by the loop, which would leave the task only weakly referenced
+_tunnel_tasks = set()
+
+async def tunnel_async(req, writer, host, port, c_reader):
+    try:
+        s_reader, s_writer = await connect_upstream_async(host, port)
+    except socket.gaierror:
+        await send_log_error_response_async(writer, req, 502, "Bad Gateway", "could not resolve")
+        return
+    except ConnectionRefusedError:
+        await send_log_error_response_async(writer, req, 502, "Bad Gateway", "connection refused")
+        return
+    except asyncio.TimeoutError:
+        await send_log_error_response_async(writer, req, 504, "Gateway Timeout", "timed out")
+        return
+    try:
+        resp_line = f"{req.version} 200 Connection Established\r\n"
+        resp_line += f"Via: 1.1 z5592060\r\nConnection: close\r\n\r\n"
+        writer.write(resp_line.encode('ascii'))
+        await writer.drain()
+
+        dummy_response = HTTPResponse(req.version, 200, "Connection Established")
+        log_request(req, dummy_response, writer.get_extra_info('peername'), cache_flag='-')
+
+        # relay until both directions have ended, or either fails
+        tasks = [asyncio.ensure_future(_pipe(c_reader, s_writer)),
+                 asyncio.ensure_future(_pipe(s_reader, writer))]
+        _tunnel_tasks.add(asyncio.current_task())
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            _tunnel_tasks.discard(asyncio.current_task())
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        s_writer.close()
+
+# handle client connection on the event loop
+async def handle_client_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    client_addr = writer.get_extra_info('peername')
+    if not admission.admit(client_addr[0]):
+        writer.write(BUSY_RESPONSE)
+        writer.close()
+        return
+    flight = None
+    try:
+        # loop for persistence
+        while True:
+            # read request from client
+            try:
+                req_buf = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), TIMEOUT)
+            except asyncio.TimeoutError:
+                if VERBOSE:
+                    print("Timeout while receiving request")
+                return
+            except asyncio.IncompleteReadError:
+                return
+            except asyncio.LimitOverrunError:
+                temp = HTTPRequest("GET", "", "HTTP/1.1")
+                await send_log_error_response_async(writer, temp, 431, "Request Header Fields Too Large", "head too large")
+                return
+            started = time.perf_counter()
+            try:
+                req, _ = parse_request_head(req_buf)
+            except ValueError:
+                temp = HTTPRequest("GET", "", "HTTP/1.1")
+                await send_log_error_response_async(writer, temp, 400, "Bad Request", "malformed request")
+                return
+            stats.observe('parse', time.perf_counter() - started)
+            # if request contains a body, read it
+            try:
+                framing = request_framing(req)
+                decoder = make_decoder(framing, req.headers)
+                req.body = b''.join([piece async for piece in aiter_body(reader, decoder)])
+            except asyncio.TimeoutError:
+                return
+            except ValueError:
+                await send_log_error_response_async(writer, req, 400, "Bad Request", "malformed request")
+                return
+            if framing == 'chunked':
+                req.headers.pop('transfer-encoding', None)
+                req.headers['content-length'] = str(len(req.body))
+
+            client_conn_hdr = req.headers.get('connection')
+            client_proxy_hdr = req.headers.get('proxy-connection')
+
+            if req.method == 'GET' and is_stats_request(req):
+                res, data, end_conn = stats_response(req, client_conn_hdr, client_proxy_hdr)
+                writer.write(data)
+                await writer.drain()
+                log_request(req, res, client_addr, '-')
+                if end_conn:
+                    break
+                continue
+
+            if req.method != 'CONNECT' and req.headers.get('host') is None:
+                await send_log_error_response_async(writer, req, 400, "Bad Request", "no host")
+                return
+
+            cache_flag = '-'
+            stale = None
+            if req.method == 'GET':
+                cache_key, cached = await cache_lookup_async(req)
+                if cached is not None and not cached.satisfies(req):
+                    # stale, or the client asked for it to be checked with the origin
+                    stale, cached = cached, None
+                cache_flag = 'H'
+                # range misses go to the origin straight away, a 206 cannot finish a flight
+                if not cached and 'range' not in req.headers:
+                    # wait for a fetch of the same URL already in progress
+                    pending_flight, leader = coalescer.join(cache_key)
+                    if leader:
+                        flight = pending_flight
+                    else:
+                        cached = await cache_call_async(coalesced_entry, req, cache_key,
+                                                        await pending_flight.wait_async(TIMEOUT))
+                        cache_flag = 'C'
+                if cached:
+                    if cached.decodes_for(req):
+                        await asyncio.get_running_loop().run_in_executor(None, cached.decoded)
+                    res, parts, end_conn, size = hit_response_parts(cached, req, client_conn_hdr, client_proxy_hdr)
+                    await send_cached_async(writer, cached, parts)
+                    stats.observe('hit', time.perf_counter() - started)
+                    log_request(req, res, client_addr, cache_flag, size)
+                    if end_conn:
+                        break
+                    continue
+                cache_flag = 'M'
+
+            if VERBOSE:
+                print(f"[async] {client_addr} {req}")
+
+            # handle connect method
+            if req.method == 'CONNECT':
+                try:
+                    host, port_str = req.url.split(':', 1)
+                    port = int(port_str)
+                except ValueError:
+                    await send_log_error_response_async(writer, req, 400, "Bad Request", "invalid port")
+                    return
+                if port != 443:
+                    await send_log_error_response_async(writer, req, 400, "Bad Request", "invalid port")
+                    return
+                if is_proxy_address(host, port):
+                    await send_log_error_response_async(writer, req, 421, "Misdirected Request", "proxy address")
+                    return
+                await tunnel_async(req, writer, host, port, reader)
+                return
+
+            # other methods get, post, put
+            revalidating = add_validators(req, stale)
+            try:
+                host, port, forward_data = prepare_forward(req)
+            except ValueError:
+                await send_log_error_response_async(writer, req, 400, "Bad Request", "invalid port")
+                return
+            if is_proxy_address(host, port):
+                await send_log_error_response_async(writer, req, 421, "Misdirected Request", "proxy address")
+                return
+
+            try:
+                # send to the origin and receive the response head
+                sent = time.perf_counter()
+                conn, resp_hdr_buf = await forward_upstream_async(host, port, req.method, forward_data)
+                stats.observe('upstream_ttfb', time.perf_counter() - sent)
+            except asyncio.TimeoutError:
+                await send_log_error_response_async(writer, req, 504, "Gateway Timeout", "timed out")
+                return
+            except ConnectionRefusedError:
+                await send_log_error_response_async(writer, req, 502, "Bad Gateway", "connection refused")
+                return
+            except socket.gaierror:
+                await send_log_error_response_async(writer, req, 502, "Bad Gateway", "could not resolve")
+                return
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                await send_log_error_response_async(writer, req, 502, "Bad Gateway", "closed unexpectedly")
+                return
+
+            reusable = False
+            origin_reusable = False
+            refreshed = None
+            try:
+                try:
+                    res, _ = parse_response_head(resp_hdr_buf)
+                except ValueError:
+                    await send_log_error_response_async(writer, req, 502, "Bad Gateway", "closed unexpectedly")
+                    return
+                # decided from the origin's own head, before the client's connection headers replace it
+                origin_reusable = upstream_reusable(res)
+                framing = response_framing(req, res)
+                try:
+                    decoder = make_decoder(framing, res.headers)
+                except ValueError:
+                    await send_log_error_response_async(writer, req, 502, "Bad Gateway", "invalid content-length")
+                    return
+                if res.status_code == 206 and req.method == 'GET':
+                    fill_after_range(req, res)
+
+                if revalidating is not None and res.status_code == 304:
+                    # the stored copy is still valid, answer from it below
+                    refreshed = await cache_call_async(refresh_entry, cache_key, revalidating, res)
+                    reusable = True
+                else:
+                    # send the head now and stream the body as it arrives
+                    end_conn = apply_connection_headers(res, client_conn_hdr, client_proxy_hdr)
+                    tee = BodyTee(req, res, framing)
+                    if tee.close_delimited:
+                        end_conn = True
+                    if flight is not None and tee.buf is None:
+                        # not storable, waiting requests go to the origin without waiting for the body
+                        coalescer.finish(cache_key, flight, None)
+                        flight = None
+                    writer.write(response_head_bytes(res))
+                    try:
+                        relay_start = time.perf_counter()
+                        async for piece in aiter_body(conn[0], decoder):
+                            writer.write(tee.frame(piece))
+                            if flight is not None and tee.buf is None:
+                                # the body outgrew the cache, waiting requests fetch it themselves
+                                coalescer.finish(cache_key, flight, None)
+                                flight = None
+                            await writer.drain()
+                        writer.write(tee.end())
+                        await writer.drain()
+                        stats.observe('transfer', time.perf_counter() - relay_start)
+                        reusable = framing != 'close'
+                    except (asyncio.TimeoutError, OSError, ValueError, asyncio.LimitOverrunError) as e:
+                        # too late for an error response, drop the client connection instead
+                        if VERBOSE:
+                            print(f"Error relaying response body: {e}")
+                        tee.discard()
+                        log_request(req, res, client_addr, cache_flag, tee.length)
+                        return
+            finally:
+                if reusable and origin_reusable:
+                    async_upstream_pool.release(host, port, conn)
+                else:
+                    conn[1].close()
+
+            if refreshed is not None:
+                if flight is not None:
+                    coalescer.finish(cache_key, flight, refreshed)
+                    flight = None
+                if refreshed.decodes_for(req):
+                    await asyncio.get_running_loop().run_in_executor(None, refreshed.decoded)
+                res, parts, end_conn, size = hit_response_parts(refreshed, req, client_conn_hdr, client_proxy_hdr)
+                await send_cached_async(writer, refreshed, parts)
+                log_request(req, res, client_addr, 'R', size)
+                if end_conn:
+                    break
+                continue
+
+            if req.method == 'GET':
+                # compressing the body, moving a spill file or sending it to the cache
+                # process happens off the event loop
+                if tee.buf is not None and tee.length >= COMPRESS_MIN_SIZE:
+                    cached = await asyncio.get_running_loop().run_in_executor(None, tee.store, req)
+                else:
+                    cached = await cache_call_async(tee.store, req)
+                if flight is not None:
+                    coalescer.finish(cache_key, flight, cached)
+                    flight = None
+
+            # log the request and response
+            stats.observe('miss', time.perf_counter() - started)
+            log_request(req, res, client_addr, cache_flag, tee.length)
+
+            if end_conn:
+                break
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    except Exception as e:
+        print(f"Error handling client: {e}")
+        traceback.print_exc()
+        try:
+            writer.write(b"HTTP/1.1 500 Internal Server Error\r\n\r\n")
+        except Exception:
+            pass
+    finally:
+        if flight is not None:
+            coalescer.finish(cache_key, flight, None)
+        writer.close()
+        admission.release(client_addr[0])
+
+# raise the open file limit so the event loop can hold many thousands of sockets
+def _raise_nofile_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+async def serve_async():
+    _raise_nofile_limit()
+    server = await asyncio.start_server(
+        handle_client_async, HOST, PORT, reuse_address=True, reuse_port=WORKERS > 1,
+        backlog=4096, limit=ASYNC_STREAM_LIMIT)
+    print(f"Proxy server listening on {HOST}:{PORT} (async)")    # only once
+    async with server:
+        await server.serve_forever()
+
+# accept loop for the thread-per-client engine
+def serve_threaded():
+    global worker_pool
+    worker_pool = WorkerPool(MAX_WORKERS, ACCEPT_QUEUE)
     # start the proxy server
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as proxy_sock:
         proxy_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if WORKERS > 1:
+            proxy_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         proxy_sock.bind((HOST, PORT))
         proxy_sock.listen()
         # set timeout for 1s so that Ctrl+C can go through
@@ -575,17 +3569,505 @@ def main():
                 if VERBOSE:
                     print(f"Accepted connection from {client_addr}")
 
-                # start a new thread for concurrency
-                thread = threading.Thread(
-                    target=handle_client, 
-                    args=(client_conn,), 
-                    daemon=True
-                )
-                thread.start()
-                if VERBOSE:
-                    print(f"Started thread {thread.name} for client {client_addr}")
+                # hand the connection to a worker, or turn it away straight away
+                ip = client_addr[0]
+                if not admission.admit(ip):
+                    reject_busy(client_conn)
+                    if VERBOSE:
+                        print(f"Rejected {client_addr}: too many connections from {ip}")
+                elif not worker_pool.submit(client_conn, ip):
+                    admission.release(ip)
+                    admission.busy()
+                    reject_busy(client_conn)
+                    if VERBOSE:
+                        print(f"Rejected {client_addr}: all workers busy")
         except KeyboardInterrupt:
             print("\nShutting down server... (Ctrl+C)")
-            
+            print(f"Admission: {admission.stats()}, queued: {worker_pool.depth()}")
+
+# ---------------------------------------------------------------------------
+# multi-process mode (--workers N)
+# N worker processes accept on the same port with SO_REUSEPORT and run the chosen
+# engine; the cache lives in one more process that workers reach over a unix
+# socket, so a response cached by one worker is a hit in all of them
+# ---------------------------------------------------------------------------
+
+_ENTRY_META = struct.Struct('!I')
+
+# a cache entry as buffers to send or write: meta length, JSON meta with the key,
+# then the body; a disk entry carries the path of its body file instead
+def entry_parts(key: str, entry: CacheEntry) -> list:
+    meta = entry.meta()
+    meta['key'] = key
+    body = b''
+    if isinstance(entry, DiskEntry):
+        meta['path'] = entry.path
+    else:
+        body = entry.body
+    meta = json.dumps(meta, separators=(',', ':')).encode()
+    return [_ENTRY_META.pack(len(meta)), meta, body]
+
+def unpack_entry(data) -> Tuple[str, CacheEntry]:
+    (length,) = _ENTRY_META.unpack_from(data)
+    start = _ENTRY_META.size
+    meta = json.loads(bytes(data[start:start+length]))
+    res = response_from_meta(meta, bytes(data[start+length:]))
+    if 'path' in meta:
+        entry = DiskEntry(res, meta['path'], meta['size'])
+    else:
+        entry = CacheEntry(res)
+    return meta['key'], entry.restore(meta)
+
+def _recv_exactly(sock: socket.socket, n: int) -> bytearray:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        got = sock.recv_into(view[pos:])
+        if not got:
+            raise ConnectionError("cache connection closed")
+        pos += got
+    return buf
+
+def _recv_record(sock: socket.socket) -> Tuple[bytes, bytearray]:
+    op, length = _RECORD.unpack(_recv_exactly(sock, _RECORD.size))
+    return op, _recv_exactly(sock, length)
+
+# the part of MAX_CACHE_SIZE shared out among the workers' local caches, the cache
+# process keeps the rest
+LOCAL_CACHE_SHARE = 0.25
+
+# bytes for each worker's local cache and for the cache process, MAX_CACHE_SIZE in all
+def cache_budgets() -> Tuple[int, int]:
+    local = int(MAX_CACHE_SIZE * LOCAL_CACHE_SHARE) // WORKERS
+    return local, MAX_CACHE_SIZE - local * WORKERS
+
+# the cache process: 'G' key answers 'E' entry or 'N' with the Vary names of the key's
+# URL, 'P' entry stores without an answer and records the names its key was made
+# from, 'A' entry whose body a worker spilled to a file moves it into the disk tier
+# and answers 'E' with the stored entry or 'N'; it owns the cache, so it warms it
+# before workers start and snapshots it when stopped
+def serve_cache(path: str):
+    global cache
+    cache = ShardedCache(cache_budgets()[1], CACHE_SHARDS, EVICTION)
+    if DISK_CACHE_DIR:
+        open_disk_cache()
+    warm_cache()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+            listener.bind(path)
+            listener.listen(1024)
+            while True:
+                conn, _ = listener.accept()
+                threading.Thread(target=_serve_cache_conn, args=(conn,), daemon=True).start()
+    finally:
+        if SNAPSHOT_FILE:
+            save_snapshot(SNAPSHOT_FILE)
+
+def _serve_cache_conn(conn: socket.socket):
+    with conn:
+        try:
+            while True:
+                op, payload = _recv_record(conn)
+                if op == b'G':
+                    key = payload.decode()
+                    entry = cache_get(key)
+                    if entry is None:
+                        with _vary_lock:
+                            names = _vary_index.get(variant_names(key)[0], ())
+                        names = '\n'.join(names).encode()
+                        conn.sendall(_RECORD.pack(b'N', len(names)) + names)
+                        continue
+                    parts = entry_parts(key, entry)
+                    send_parts(conn, [_RECORD.pack(b'E', sum(len(p) for p in parts))] + parts)
+                elif op == b'P':
+                    key, entry = unpack_entry(payload)
+                    record_vary(*variant_names(key))
+                    if not isinstance(entry, DiskEntry):
+                        cache.put(key, entry)
+                    elif disk_cache is not None:
+                        disk_cache.put(key, entry)
+                elif op == b'A':
+                    key, entry = unpack_entry(payload)
+                    record_vary(*variant_names(key))
+                    try:
+                        if disk_cache is None:
+                            raise OSError("no disk cache")
+                        entry = disk_cache.adopt(key, entry.meta(), entry.path)
+                    except OSError:
+                        try:
+                            os.unlink(entry.path)
+                        except OSError:
+                            pass
+                        conn.sendall(_RECORD.pack(b'N', 0))
+                        continue
+                    parts = entry_parts(key, entry)
+                    send_parts(conn, [_RECORD.pack(b'E', sum(len(p) for p in parts))] + parts)
+        except OSError:
+            pass
+
+# stands in for the ShardedCache in worker processes: a small local cache in
+# front of the cache process, with one connection to it per thread
+class CacheClient:
+    def __init__(self, path: str, local_bytes: int, shards: int):
+        self.path = path
+        self.local = ShardedCache(local_bytes, shards, EVICTION)
+        self.conns = threading.local()
+
+    def _call(self, op: bytes, parts: list, reply: bool):
+        sock = getattr(self.conns, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self.conns.sock = sock
+        try:
+            send_parts(sock, [_RECORD.pack(op, sum(len(p) for p in parts))] + parts)
+            return _recv_record(sock) if reply else None
+        except OSError:
+            sock.close()
+            self.conns.sock = None
+            raise
+
+    def get(self, key: str):
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+        try:
+            op, payload = self._call(b'G', [key.encode()], reply=True)
+        except OSError:
+            return None
+        if op == b'N':
+            record_vary(variant_names(key)[0], payload.decode().split('\n') if payload else ())
+            return None
+        _, entry = unpack_entry(payload)
+        if not isinstance(entry, DiskEntry):
+            self.local.put(key, entry)
+        return entry
+
+    def put(self, key: str, entry: CacheEntry):
+        if not isinstance(entry, DiskEntry):
+            self.local.put(key, entry)
+        try:
+            self._call(b'P', entry_parts(key, entry), reply=False)
+        except OSError:
+            pass
+
+    # hand a body spilled to tmp_path to the cache process's disk tier, returns
+    # the stored entry or None
+    def adopt(self, key: str, meta: dict, tmp_path: str):
+        spilled = DiskEntry(response_from_meta(meta), tmp_path, meta['size']).restore(meta)
+        try:
+            op, payload = self._call(b'A', entry_parts(key, spilled), reply=True)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return None
+        return unpack_entry(payload)[1] if op == b'E' else None
+
+# stands in for the DiskCache in worker processes: bodies too large for memory
+# are spilled into the cache process's directory and adopted by it, lookups and
+# stores go through the CacheClient
+class DiskClient:
+    def __init__(self, directory: str, max_object_size: int, client: CacheClient):
+        self.dir = directory
+        self.max_object_size = max_object_size
+        self.client = client
+
+    def get(self, key: str):
+        return None
+
+    def put(self, key: str, entry: DiskEntry):
+        self.client.put(key, entry)
+
+    def accepts(self, size: int) -> bool:
+        return size <= self.max_object_size
+
+    def spill_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.dir, suffix='.tmp', delete=False)
+
+    def adopt(self, key: str, meta: dict, tmp_path: str):
+        return self.client.adopt(key, meta, tmp_path)
+
+def serve_worker(path: str):
+    global cache, disk_cache
+    cache = CacheClient(path, cache_budgets()[0], CACHE_SHARDS)
+    if DISK_CACHE_DIR:
+        disk_cache = DiskClient(DISK_CACHE_DIR, DISK_MAX_OBJECT_SIZE, cache)
+    if ENGINE == 'async':
+        asyncio.run(serve_async())
+    else:
+        serve_threaded()
+
+# run fn in a forked child until it returns or is stopped, then exit the child
+def _fork(fn, *args) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        fn(*args)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        access_log.close()
+        os._exit(0)
+
+def serve_workers():
+    sock_dir = tempfile.mkdtemp(prefix='proxy-cache-')
+    path = os.path.join(sock_dir, 'cache.sock')
+    children = [_fork(serve_cache, path)]
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        children += [_fork(serve_worker, path) for _ in range(WORKERS)]
+        print(f"Proxy server listening on {HOST}:{PORT} ({WORKERS} workers)")
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        print("\nShutting down server... (Ctrl+C)")
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        shutil.rmtree(sock_dir, ignore_errors=True)
+
+# ---------------------------------------------------------------------------
+# cache warm-up (--snapshot, --prefetch)
+# a restarted proxy starts from a snapshot of the memory cache, then fetches
+# the URLs most requested in an access log that the snapshot did not bring
+# back, before it accepts clients
+# ---------------------------------------------------------------------------
+
+# snapshot file: this line, then records framed as in the disk index: 'V' the
+# Vary index as JSON, then 'E' one entry as entry_parts() lays it out, oldest first
+SNAPSHOT_MAGIC = b'proxy cache snapshot 1\n'
+_snapshot_lock = threading.Lock()
+
+# write the memory cache to path, replacing the previous snapshot only once complete
+def save_snapshot(path: str):
+    started = time.perf_counter()
+    tmp = path + '.tmp'
+    count = size = 0
+    with _snapshot_lock:
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC)
+                with _vary_lock:
+                    vary = json.dumps(list(_vary_index.items()), separators=(',', ':')).encode()
+                f.write(_RECORD.pack(b'V', len(vary)))
+                f.write(vary)
+                for key, entry in cache.items():
+                    # disk entries are kept by the disk tier's own index
+                    if isinstance(entry, DiskEntry):
+                        continue
+                    parts = entry_parts(key, entry)
+                    f.write(_RECORD.pack(b'E', sum(len(p) for p in parts)))
+                    for part in parts:
+                        f.write(part)
+                    count += 1
+                    size += entry.size
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Cache snapshot failed: {e}")
+            return
+    print(f"Saved {count} cached objects ({size} bytes) to {path} in {time.perf_counter() - started:.2f}s")
+
+# load a snapshot into the memory cache, skipping entries that could neither be
+# served nor revalidated; a snapshot cut short or with a corrupt record loads up
+# to the last good record
+def load_snapshot(path: str):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        print(f"Cache snapshot not loaded: {e}")
+        return
+    if not data.startswith(SNAPSHOT_MAGIC):
+        print(f"Cache snapshot not loaded: {path} is not a snapshot")
+        return
+    view = memoryview(data)
+    pos = len(SNAPSHOT_MAGIC)
+    count = size = 0
+    while pos + _RECORD.size <= len(data):
+        op, length = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        if pos + length > len(data):
+            break
+        payload = view[pos:pos+length]
+        pos += length
+        try:
+            if op == b'V':
+                vary = [(url_key, tuple(names)) for url_key, names in json.loads(bytes(payload))]
+                with _vary_lock:
+                    _vary_index.update(vary)
+                continue
+            if op != b'E':
+                continue
+            key, entry = unpack_entry(payload)
+            expired = entry.age() >= entry.lifetime and not (entry.etag or entry.last_modified)
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            print(f"Cache snapshot {path} has a corrupt record, loading stopped there: {e!r}")
+            break
+        if expired:
+            continue
+        cache.put(key, entry)
+        count += 1
+        size += entry.size
+    print(f"Loaded {count} cached objects ({size} bytes) from {path}")
+
+def _snapshot_loop(path: str, interval: float):
+    while True:
+        time.sleep(interval)
+        save_snapshot(path)
+
+# matches the lines generate_clf_entry() writes, capturing the cache flag,
+# method, URL and status
+_LOG_LINE = re.compile(r'^\S+ \S+ (\S) \[[^\]]*\] "(\S+) (\S+) [^"]*" (\d{3}) \S+$')
+
+# the limit most requested URLs of an access log, most requested first: GETs
+# answered 200 through the cache, from it or from the origin
+def popular_urls(path: str, limit: int) -> list:
+    counts = Counter()
+    with open(path, encoding='latin-1') as log_file:
+        for line in log_file:
+            m = _LOG_LINE.match(line.strip())
+            if m and m.group(1) in 'HMCR' and m.group(2) == 'GET' and m.group(4) == '200':
+                counts[normalise_url(m.group(3))] += 1
+    return [url for url, _ in counts.most_common(limit)]
+
+# fetch url from its origin into the cache as a miss would, without a client;
+# returns True if the response was stored
+def prefetch_url(url: str) -> bool:
+    req = HTTPRequest('GET', url, 'HTTP/1.1')
+    req.headers['accept-encoding'] = 'gzip'
+    _, entry = cache_lookup(req)
+    if entry is not None and entry.satisfies(req):
+        return False
+    host, port, forward_data = prepare_forward(req)
+    upstream = SocketReader()
+    server_sock, head = forward_upstream(upstream, host, port, req.method, forward_data)
+    reusable = False
+    tee = None
+    try:
+        res, body_start = parse_response_head(upstream.buf, head)
+        upstream.consume(body_start)
+        framing = response_framing(req, res)
+        decoder = make_decoder(framing, res.headers)
+        tee = BodyTee(req, res, framing)
+        if tee.buf is None:
+            return False
+        server_sock.settimeout(TIMEOUT)
+        for piece in iter_body(upstream, decoder):
+            tee.frame(piece)
+            if tee.buf is None:
+                # grew past anything the cache keeps
+                return False
+        reusable = framing != 'close' and not decoder.unused
+    except BaseException:
+        if tee is not None:
+            tee.discard()
+        raise
+    finally:
+        if reusable and upstream_reusable(res):
+            upstream_pool.release(host, port, server_sock)
+        else:
+            server_sock.close()
+    return tee.store(req) is not None
+
+def _prefetch_one(url: str) -> bool:
+    try:
+        return prefetch_url(url)
+    except (OSError, ValueError) as e:
+        if VERBOSE:
+            print(f"Prefetch of {url} failed: {e}")
+        return False
+
+# fetch the most requested URLs of an access log, parallel fetches at a time
+def prefetch(path: str, count: int, parallel: int):
+    started = time.perf_counter()
+    try:
+        urls = popular_urls(path, count)
+    except OSError as e:
+        print(f"Prefetch skipped: {e}")
+        return
+    with concurrent.futures.ThreadPoolExecutor(parallel, thread_name_prefix='prefetch') as pool:
+        stored = sum(pool.map(_prefetch_one, urls))
+    print(f"Prefetched {stored} of {len(urls)} popular URLs from {path} in {time.perf_counter() - started:.2f}s")
+
+# a range miss the origin answers with 206 starts a fetch of the whole object in
+# the background, once per URL at a time and only if the cache would keep it,
+# so the ranges that follow are served from the cache
+RANGE_FILL_PARALLEL = 4
+_range_fill_pool = concurrent.futures.ThreadPoolExecutor(RANGE_FILL_PARALLEL, thread_name_prefix='range-fill')
+_range_fills = set()
+_range_fills_lock = threading.Lock()
+
+# complete length from a Content-Range value, None if unknown or invalid
+def content_range_size(value):
+    _, _, size = (value or '').rpartition('/')
+    return int(size) if size.strip().isdigit() else None
+
+def fill_after_range(req: HTTPRequest, res: HTTPResponse):
+    size = content_range_size(res.headers.get('content-range'))
+    limit = max(MAX_OBJECT_SIZE, DISK_MAX_OBJECT_SIZE if disk_cache is not None else 0)
+    if size is None or size > limit or 'authorization' in req.headers:
+        return
+    url_key = normalise_url(req.url)
+    with _range_fills_lock:
+        if url_key in _range_fills:
+            return
+        _range_fills.add(url_key)
+    stats.count('range_fills')
+    _range_fill_pool.submit(_range_fill, req.url, url_key)
+
+def _range_fill(url: str, url_key: str):
+    try:
+        _prefetch_one(url)
+    finally:
+        with _range_fills_lock:
+            _range_fills.discard(url_key)
+
+# fill the cache before serving: the snapshot first, then the popular URLs it
+# did not bring back, and keep snapshotting while running
+def warm_cache():
+    if SNAPSHOT_FILE:
+        load_snapshot(SNAPSHOT_FILE)
+        if SNAPSHOT_INTERVAL > 0:
+            threading.Thread(target=_snapshot_loop, args=(SNAPSHOT_FILE, SNAPSHOT_INTERVAL),
+                             name='snapshot', daemon=True).start()
+    if PREFETCH_LOG and PREFETCH_COUNT:
+        prefetch(PREFETCH_LOG, PREFETCH_COUNT, PREFETCH_PARALLEL)
+
+# shut down on kill the same way as on Ctrl+C
+def _sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+# main
+def main():
+    parse_args(sys.argv[1:])
+    signal.signal(signal.SIGTERM, _sigterm)
+    try:
+        if WORKERS > 1:
+            serve_workers()
+        else:
+            warm_cache()
+            if ENGINE == 'async':
+                try:
+                    asyncio.run(serve_async())
+                except KeyboardInterrupt:
+                    print("\nShutting down server... (Ctrl+C)")
+            else:
+                serve_threaded()
+    finally:
+        if SNAPSHOT_FILE and WORKERS == 1:
+            save_snapshot(SNAPSHOT_FILE)
+        access_log.close()
+
 if __name__=='__main__':
     main()
\ No newline at end of file
@@ -2,78 +2,256 @@
 import socket
 import sys
 import os
+import stat
 import mimetypes
+import asyncio
+import email.utils
+import time
+from collections import OrderedDict
+
+MAX_HEAD = 64 * 1024
+# files at least this large are sent with sendfile, smaller ones are kept in
+# memory and sent with the head in one write
+SENDFILE_MIN = 64 * 1024
+
+# content type, validators and headers of each file served, reused while its
+# modification time and size stay the same
+FILE_INFO_SIZE = 4096
+_file_info = {}
+
+def file_info(file_path, st):
+    info = _file_info.get(file_path)
+    if info is None or info[0] != (st.st_mtime_ns, st.st_size):
+        etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        mime_type, _ = mimetypes.guess_type(file_path)
+        if not mime_type:
+            mime_type = 'application/octet-stream'
+        headers = (
+            f"Content-Type: {mime_type}\r\n"
+            f"Content-Length: {st.st_size}\r\n"
+            f"ETag: {etag}\r\n"
+            f"Last-Modified: {last_modified}\r\n"
+        )
+        if len(_file_info) >= FILE_INFO_SIZE:
+            _file_info.clear()
+        info = _file_info[file_path] = ((st.st_mtime_ns, st.st_size), etag, int(st.st_mtime), last_modified, headers)
+    return info
+
+# small files kept in memory with their response heads, so that repeated
+# requests make no filesystem calls. An entry is checked against the file's
+# mtime and size at most every HOT_CHECK_INTERVAL seconds, and the least
+# recently used go once the bodies kept pass HOT_CACHE_SIZE
+HOT_CACHE_SIZE = 32 * 1024 * 1024
+HOT_CHECK_INTERVAL = 1.0
+_hot_files = OrderedDict()
+_hot_size = 0
+
+class HotFile:
+    def __init__(self, info, body):
+        self.info = info
+        self.body = body
+        self.checked = time.monotonic()
+        self.heads = {}
+
+    # the 200 head for a request version and Connection line, formatted once
+    def head(self, version, connection):
+        head = self.heads.get((version, connection))
+        if head is None:
+            head = f"{version} 200 OK\r\n{self.info[4]}{connection}\r\n".encode()
+            if len(self.heads) < 4:
+                self.heads[(version, connection)] = head
+        return head
+
+# the kept file at file_path, or None if it is not kept or has changed
+def hot_file(file_path):
+    global _hot_size
+    entry = _hot_files.get(file_path)
+    if entry is None:
+        return None
+    now = time.monotonic()
+    if now - entry.checked >= HOT_CHECK_INTERVAL:
+        try:
+            st = os.stat(file_path)
+            current = stat.S_ISREG(st.st_mode) and (st.st_mtime_ns, st.st_size) == entry.info[0]
+        except OSError:
+            current = False
+        if not current:
+            del _hot_files[file_path]
+            _hot_size -= len(entry.body)
+            return None
+        entry.checked = now
+    _hot_files.move_to_end(file_path)
+    return entry
+
+def keep_hot_file(file_path, info, body):
+    global _hot_size
+    entry = _hot_files[file_path] = HotFile(info, body)
+    _hot_size += len(body)
+    while _hot_size > HOT_CACHE_SIZE:
+        _, old = _hot_files.popitem(last=False)
+        _hot_size -= len(old.body)
+    return entry
+
+# true if the client's copy is current: If-None-Match names the ETag, or without
+# it, If-Modified-Since is no earlier than the modification time
+def not_modified(headers, etag, mtime):
+    if 'if-none-match' in headers:
+        tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    if 'if-modified-since' in headers:
+        try:
+            return mtime <= email.utils.parsedate_to_datetime(headers['if-modified-since']).timestamp()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+    return False
+
+# method, path, version and headers by lowercase name, or None if malformed
+def parse_request(head):
+    lines = head.decode('iso-8859-1').split("\r\n")
+    request_line = lines[0].split()
+    if len(request_line) != 3:
+        return None
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return (*request_line, headers)
+
+# bytes to send, the open file whose contents follow them or None, and whether
+# the connection stays open
+def respond(method, path, version, req_headers):
+    if method != 'GET':
+        response = f"{version} 405 Method Not Allowed\r\nConnection: close\r\n\r\n"
+        return response.encode(), None, False
+
+    if path == '/favicon.ico':
+        response = f"{version} 204 No Content\r\nConnection: close\r\n\r\n"
+        return response.encode(), None, False
+
+    file_path = path.lstrip('/') or 'index.html'
+    keep_alive = req_headers.get('connection', '').lower() != 'close'
+    connection = "Connection: keep-alive\r\n" if keep_alive else "Connection: close\r\n"
+
+    entry = hot_file(file_path)
+    if entry is None:
+        try:
+            f = open(file_path, 'rb')
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                f.close()
+                f = None
+        except OSError:
+            f = None
+        if f is None:
+            body = b"<html><body><h1>404 Not Found</h1></body></html>"
+            headers = [
+                f"{version} 404 Not Found",
+                "Content-Type: text/html; charset=utf-8",
+                f"Content-Length: {len(body)}",
+                "Connection: close",
+                "",
+                ""
+            ]
+            header_data = "\r\n".join(headers).encode()
+            return header_data + body, None, False
+
+        info = file_info(file_path, st)
+        if st.st_size >= SENDFILE_MIN:
+            if not_modified(req_headers, info[1], info[2]):
+                f.close()
+                return not_modified_head(version, info, connection), None, keep_alive
+            return f"{version} 200 OK\r\n{info[4]}{connection}\r\n".encode(), f, keep_alive
+        with f:
+            entry = keep_hot_file(file_path, info, f.read())
+
+    if not_modified(req_headers, entry.info[1], entry.info[2]):
+        return not_modified_head(version, entry.info, connection), None, keep_alive
+    return entry.head(version, connection) + entry.body, None, keep_alive
+
+def not_modified_head(version, info, connection):
+    _, etag, _, last_modified, _ = info
+    return f"{version} 304 Not Modified\r\nETag: {etag}\r\nLast-Modified: {last_modified}\r\n{connection}\r\n".encode()
 
 def handle_client(conn, addr):
     with conn:
+        # bytes received after a request head belong to the next request
+        data = bytearray()
         while True:
-            data = b""
-            while b"\r\n\r\n" not in data:
-                chunk = conn.recv(1024)
+            end = data.find(b"\r\n\r\n")
+            while end < 0:
+                if len(data) > MAX_HEAD:
+                    return
+                chunk = conn.recv(65536)
                 if not chunk:
                     return
                 data += chunk
+                end = data.find(b"\r\n\r\n", max(0, len(data) - len(chunk) - 3))
 
-            header_text = data.split(b"\r\n\r\n")[0].decode('iso-8859-1')
-            lines = header_text.split("\r\n")
-            request_line = lines[0].split()
-            if len(request_line) < 3:
+            request = parse_request(bytes(data[:end]))
+            del data[:end+4]
+            if request is None:
                 return
-            method, path, version = request_line
 
-            if method != 'GET':
-                response = f"{version} 405 Method Not Allowed\r\nConnection: close\r\n\r\n"
-                conn.sendall(response.encode())
+            response, f, keep_alive = respond(*request)
+            conn.sendall(response)
+            if f is not None:
+                with f:
+                    conn.sendfile(f)
+            if not keep_alive:
                 return
 
-            if path == '/favicon.ico':
-                response = f"{version} 204 No Content\r\nConnection: close\r\n\r\n"
-                conn.sendall(response.encode())
+# concurrent mode (--async): every connection is a task on one event loop, and
+# file bodies go from the file to the socket with sendfile
+async def handle_client_async(reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
                 return
-
-            file_path = path.lstrip('/') or 'index.html'
-
-            if not os.path.isfile(file_path):
-                body = b"<html><body><h1>404 Not Found</h1></body></html>"
-                headers = [
-                    f"{version} 404 Not Found",
-                    "Content-Type: text/html; charset=utf-8",
-                    f"Content-Length: {len(body)}",
-                    "Connection: close",
-                    "",
-                    ""
-                ]
-                header_data = "\r\n".join(headers).encode()
-                conn.sendall(header_data + body)
+            request = parse_request(head[:-4])
+            if request is None:
                 return
 
-            with open(file_path, 'rb') as f:
-                body = f.read()
-
-            mime_type, _ = mimetypes.guess_type(file_path)
-            if not mime_type:
-                mime_type = 'application/octet-stream'
+            response, f, keep_alive = respond(*request)
+            writer.write(response)
+            if f is not None:
+                with f:
+                    await loop.sendfile(writer.transport, f)
+            else:
+                await writer.drain()
+            if not keep_alive:
+                return
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
 
-            headers = [
-                f"{version} 200 OK",
-                f"Content-Type: {mime_type}",
-                f"Content-Length: {len(body)}",
-                "Connection: keep-alive",
-                "",
-                ""
-            ]
-            header_data = "\r\n".join(headers).encode()
-            conn.sendall(header_data + body)
+async def serve_async(host, port):
+    server = await asyncio.start_server(handle_client_async, host, port,
+                                        reuse_address=True, backlog=1024, limit=MAX_HEAD)
+    print(f"Listening on {host}:{port} (async)...")
+    async with server:
+        await server.serve_forever()
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(f"Usage: python3 {sys.argv[0]} <port>")
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != '--async'):
+        print(f"Usage: python3 {sys.argv[0]} <port> [--async]")
         sys.exit(1)
 
     PORT = int(sys.argv[1])
     HOST = '0.0.0.0'
 
+    if len(sys.argv) == 3:
+        try:
+            asyncio.run(serve_async(HOST, PORT))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((HOST, PORT))
@@ -83,4 +261,6 @@ if __name__ == '__main__':
         while True:
             conn, addr = server_socket.accept()
             print(f"Connection from {addr}")
+            # the head and the file go out as separate writes, do not hold back the second
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             handle_client(conn, addr)